@@ -1,67 +1,1386 @@
-from flask import Flask, render_template, request, jsonify, session
+from flask import Flask, Response, render_template, request, jsonify, session
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
 import pandas as pd
+import numpy as np
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 from datetime import datetime
+import bisect
+import functools
+import gzip
+import hashlib
+import json
 import os
+import re
+import secrets
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+
+try:
+    import brotli
+except ImportError:  # optional; responses are gzipped instead
+    brotli = None
 
 app = Flask(__name__)
 app.secret_key = os.urandom(24)
 
-# Load data once when the app starts
+# Load data once when the app starts; the active DataSnapshot is swapped in whole on reload
+dataset = None
 df_clusters = None
 
+DATA_FILE = os.environ.get('CLUSTER_DATA_FILE', "ecommerce_customer_clusters_for_tableau.csv")
+
+# Seconds between checks of the CSV for a new export (0 disables hot reloading)
+RELOAD_INTERVAL = float(os.environ.get('CLUSTER_RELOAD_INTERVAL', '5'))
+
+# 'frame' keeps every row in memory; 'aggregate' streams the CSV in chunks and keeps only the
+# counts and sums the chatbot answers from, optionally cached in a summary file; 'approximate'
+# keeps a sample of each cluster plus heavy-hitter sketches and marks its answers as estimates
+DATA_MODE = os.environ.get('CLUSTER_DATA_MODE', 'frame')
+SUMMARY_FILE = os.environ.get('CLUSTER_SUMMARY_FILE', DATA_FILE + '.summary.npz')
+CHUNK_ROWS = int(os.environ.get('CLUSTER_CHUNK_ROWS', '500000'))
+SAMPLE_SIZE = int(os.environ.get('CLUSTER_SAMPLE_SIZE', '10000'))  # rows sampled per cluster
+SKETCH_CAPACITY = int(os.environ.get('CLUSTER_SKETCH_CAPACITY', '64'))  # counters per heavy-hitter sketch
+
+# Directory of binary snapshots of the parsed frame, keyed by the CSV's content hash and shared by
+# every worker on the host. Startups memory-map a matching snapshot instead of parsing the CSV;
+# set CLUSTER_SHARED_DIR to an empty string to always parse.
+SHARED_DATA_DIR = os.environ.get('CLUSTER_SHARED_DIR', DATA_FILE + '.snapshots')
+SHARED_KEEP_VERSIONS = 3
+
+# Declared column types for the cluster export. Strings are categorical and numbers use the
+# smallest type that fits the data; Average_Order_Value stays float64 so currency means are exact.
+CSV_SCHEMA = {
+    'Age': 'int8',
+    'Gender': 'int8',
+    'Marital_Status': 'int8',
+    'Customer_Region': 'category',
+    'Product_Category': 'category',
+    'Preferred_Payment_Method': 'category',
+    'Preferred_Delivery_Option': 'category',
+    'Device_Used': 'category',
+    'Annual_Income': 'int32',
+    'Spending_Score': 'int8',
+    'Average_Order_Value': 'float64',
+    'Number_of_Orders': 'int16',
+    'Review_Score': 'int8',
+    'Age_Group': 'category',
+    'Engagement_Level': 'category',
+    'High_Spender': 'int8',
+    'Cluster': 'int8',
+}
+
+PROFILE_MEAN_COLUMNS = ['Annual_Income', 'Spending_Score', 'Average_Order_Value',
+                        'Number_of_Orders', 'Review_Score', 'Age']
+PROFILE_MODE_COLUMNS = ['Device_Used', 'Preferred_Payment_Method', 'Product_Category', 'Customer_Region']
+PROFILE_BREAKDOWN_COLUMNS = ['Device_Used', 'Customer_Region', 'Gender']
+
+def build_cluster_profiles(df):
+    """Precompute means, modes, sizes and breakdowns for every cluster in one groupby pass"""
+    profiles = {}
+    for cluster_id, subset in df.groupby('Cluster', sort=True):
+        means = subset[PROFILE_MEAN_COLUMNS].mean()
+        modes = {}
+        for column in PROFILE_MODE_COLUMNS:
+            mode = subset[column].mode()
+            modes[column] = mode[0] if not mode.empty else "N/A"
+        breakdowns = {
+            column: [(value, int(count)) for value, count in subset[column].value_counts().items() if count]
+            for column in PROFILE_BREAKDOWN_COLUMNS
+        }
+        profiles[int(cluster_id)] = {
+            'size': len(subset),
+            'means': {column: float(means[column]) for column in PROFILE_MEAN_COLUMNS},
+            'modes': modes,
+            'breakdowns': breakdowns,
+        }
+    return profiles
+
+INDEXED_COLUMNS = ['Cluster', 'Gender', 'Product_Category', 'Customer_Region', 'Device_Used',
+                   'Preferred_Payment_Method']
+
+# Gender is stored as a 0/1 code in the export
+FEMALE = 0
+MALE = 1
+
+def intersect_sorted(smaller, larger):
+    """Intersect two sorted row arrays by probing the larger one for each row of the smaller one"""
+    if len(smaller) > len(larger):
+        smaller, larger = larger, smaller
+    if not len(smaller):
+        return smaller
+    positions = np.searchsorted(larger, smaller)
+    positions[positions == len(larger)] = 0
+    return smaller[larger[positions] == smaller]
+
+def ranked_counts(counts, values):
+    """Pair non-zero counts with their values, most common first and ties in value order"""
+    order = np.argsort(-counts, kind='stable')
+    return [(values[i], int(counts[i])) for i in order if counts[i]]
+
+class RowIndex:
+    """Inverted index from each value of the indexed columns to a sorted array of row positions"""
+
+    def __init__(self, sorted_values, orders, bounds, codes):
+        # Per column: distinct values, row positions grouped by value, each value's offsets into
+        # that array, and the per-row code into sorted_values. Arrays may be memory-mapped.
+        self.columns = list(sorted_values)
+        self.sorted_values = sorted_values
+        self.orders = orders
+        self.bounds = bounds
+        self.codes = codes
+        self.postings = {}  # column -> {value: sorted int32 row positions}
+        self.appearance = {}  # column -> values in order of first appearance, like Series.unique()
+        self.empty = np.empty(0, dtype=np.int32)
+        for column, values in sorted_values.items():
+            order, bound = orders[column], bounds[column]
+            postings = {value: order[bound[i]:bound[i + 1]] for i, value in enumerate(values)}
+            self.postings[column] = postings
+            self.appearance[column] = sorted(values, key=lambda value: postings[value][0])
+
+    @classmethod
+    def build(cls, df, columns=INDEXED_COLUMNS):
+        sorted_values, orders, bounds, codes = {}, {}, {}, {}
+        for column in columns:
+            column_codes, uniques = pd.factorize(df[column], sort=True)
+            values = np.asarray(uniques).tolist()
+            order = np.argsort(column_codes, kind='stable').astype(np.int32)
+            sorted_values[column] = values
+            orders[column] = order
+            bounds[column] = np.searchsorted(column_codes[order], np.arange(len(values) + 1))
+            codes[column] = column_codes.astype(np.min_scalar_type(max(len(values) - 1, 0)))
+        return cls(sorted_values, orders, bounds, codes)
+
+    def values(self, column):
+        """Distinct values of a column in sorted order"""
+        return self.sorted_values[column]
+
+    def rows(self, column, value):
+        """Row positions holding `value` in `column`"""
+        return self.postings[column].get(value, self.empty)
+
+    def select(self, **filters):
+        """Row positions matching every column=value filter, intersecting smallest lists first"""
+        lists = sorted((self.rows(column, value) for column, value in filters.items()), key=len)
+        result = lists[0]
+        for rows in lists[1:]:
+            result = intersect_sorted(result, rows)
+        return result
+
+    def count(self, **filters):
+        """Rows matching every column=value filter"""
+        return len(self.select(**filters))
+
+    def value_counts(self, column, **filters):
+        """(value, count) pairs for `column` among rows matching the filters, most common first"""
+        codes = self.codes[column]
+        if filters:
+            codes = codes[self.select(**filters)]
+        return ranked_counts(np.bincount(codes, minlength=len(self.sorted_values[column])),
+                             self.sorted_values[column])
+
+def check_header(path):
+    """Fail early if the CSV lacks any declared column"""
+    header = pd.read_csv(path, nrows=0).columns
+    missing = [column for column in CSV_SCHEMA if column not in header]
+    if missing:
+        raise ValueError(f"CSV is missing required columns: {', '.join(missing)}")
+
+def apply_schema(df, columns):
+    """Validate and narrow the numeric columns of a frame read with categorical dtypes"""
+    for column in columns:
+        dtype = CSV_SCHEMA[column]
+        if dtype == 'category':
+            continue
+        values = df[column]
+        if values.isna().any():
+            raise ValueError(f"Column '{column}' has missing values")
+        if np.issubdtype(np.dtype(dtype), np.integer):
+            # astype truncates fractions, so 35.7 would silently load as 35
+            if np.issubdtype(values.dtype, np.floating) and (values != np.floor(values)).any():
+                raise ValueError(f"Column '{column}' has non-integer values")
+            limits = np.iinfo(dtype)
+            if values.min() < limits.min or values.max() > limits.max:
+                raise ValueError(f"Column '{column}' has values outside the {dtype} range")
+        df[column] = values.astype(dtype)
+    return df[list(columns)]
+
+def read_clusters_csv(path):
+    """Read the cluster export with the declared schema, rejecting files that don't fit it"""
+    check_header(path)
+
+    # Categorical columns are parsed straight into categories; integers are parsed at full width
+    # first because read_csv silently wraps values that overflow a narrow dtype.
+    categorical = {column: dtype for column, dtype in CSV_SCHEMA.items() if dtype == 'category'}
+    df = pd.read_csv(path, usecols=list(CSV_SCHEMA), dtype=categorical)
+    return apply_schema(df, CSV_SCHEMA)
+
+def report_memory_usage(df):
+    """Print the in-memory footprint of each column"""
+    usage = df.memory_usage(index=False, deep=True)
+    print(f"Memory usage: {usage.sum() / 1024 ** 2:.2f} MB")
+    for column, nbytes in usage.items():
+        print(f"  {column:<28} {str(df[column].dtype):<10} {nbytes / 1024:>10.1f} KB")
+
+class DataSnapshot:
+    """One version of the customer data plus everything derived from it, swapped in as a unit"""
+
+    mode = 'frame'
+    source = 'csv'  # or 'snapshot hit' / 'snapshot rebuilt' when served from a binary snapshot
+
+    def __init__(self, df, fingerprint, digest, profiles=None, index=None, cube=None):
+        started = time.perf_counter()
+        self.df = df
+        self.rows = len(df)
+        self.profiles = build_cluster_profiles(df) if profiles is None else profiles
+        self.index = RowIndex.build(df) if index is None else index
+        self.cube = AggregateCube.build(df) if cube is None else cube
+        self.entities = EntityIndex.build(self.cube)
+        self.fingerprint = fingerprint
+        self.digest = digest
+        self.memory_bytes = int(df.memory_usage(index=False, deep=True).sum())
+        self.loaded_at = datetime.now()
+        # Parse time is added by build_snapshot
+        self.load_seconds = time.perf_counter() - started
+
+    @functools.cached_property
+    def centroids(self):
+        # Built on first use, since only /assign_clusters needs it
+        return ClusterCentroids.build(self.df)
+
+def stream_aggregates(path, chunk_rows=CHUNK_ROWS):
+    """Read the CSV in chunks into an aggregate cube, keeping only counts and measure sums per
+    combination of the cube dimensions, so memory grows with the number of groups rather than rows"""
+    check_header(path)
+    columns = CUBE_DIMENSIONS + [column for column in CUBE_MEASURES if column not in CUBE_DIMENSIONS]
+    categorical = {column: 'category' for column in columns if CSV_SCHEMA[column] == 'category'}
+    groups = {}  # tuple of dimension values -> float64 [rows, measure sums...]
+    appearance = {column: {} for column in CUBE_DIMENSIONS}  # value -> first-seen order
+    rows = 0
+    for chunk in pd.read_csv(path, usecols=columns, dtype=categorical, chunksize=chunk_rows):
+        chunk = apply_schema(chunk, columns)
+        for column in CUBE_DIMENSIONS:
+            seen = appearance[column]
+            for value in pd.unique(chunk[column]):
+                seen.setdefault(np.asarray(value).item(), len(seen))
+        grouped = chunk[CUBE_MEASURES].astype('float64').groupby(
+            [chunk[column] for column in CUBE_DIMENSIONS], observed=True, sort=False)
+        totals = grouped.sum()
+        totals.insert(0, 'rows', grouped.size())
+        for key, values in zip(totals.index.tolist(), totals.to_numpy()):
+            key = tuple(np.asarray(value).item() for value in key)
+            if key in groups:
+                groups[key] += values
+            else:
+                groups[key] = values
+        rows += len(chunk)
+
+    values = {column: sorted(appearance[column]) for column in CUBE_DIMENSIONS}
+    positions = {column: {value: i for i, value in enumerate(values[column])} for column in CUBE_DIMENSIONS}
+    shape = tuple(len(values[column]) for column in CUBE_DIMENSIONS)
+    table = np.zeros(shape, dtype=np.int64)
+    sums = np.zeros(shape + (len(CUBE_MEASURES),))
+    for key, totals in groups.items():
+        cell = tuple(positions[column][value] for column, value in zip(CUBE_DIMENSIONS, key))
+        table[cell] = int(totals[0])
+        sums[cell] = totals[1:]
+    order = {column: sorted(seen, key=seen.get) for column, seen in appearance.items()}
+    return AggregateCube(values, table, sums, order), rows
+
+def whole(counts):
+    """Round estimated (weighted) counts to whole customers; exact integer counts pass through"""
+    return np.rint(counts).astype(np.int64) if counts.dtype.kind == 'f' else counts
+
+class AggregateCounts:
+    """RowIndex counting interface answered from a dense joint count table instead of rows"""
+
+    def __init__(self, sorted_values, table, appearance, columns=INDEXED_COLUMNS):
+        self.columns = list(columns)
+        self.sorted_values = sorted_values
+        self.table = table
+        self.appearance = appearance
+        self.axes = {column: axis for axis, column in enumerate(self.columns)}
+        self.positions = {column: {value: i for i, value in enumerate(values)}
+                          for column, values in sorted_values.items()}
+
+    def values(self, column):
+        return self.sorted_values[column]
+
+    def slice(self, filters):
+        """Sub-table for the filters (keeping every axis), or None if a value never occurs"""
+        selector = [slice(None)] * len(self.columns)
+        for column, value in filters.items():
+            position = self.positions[column].get(value)
+            if position is None:
+                return None
+            selector[self.axes[column]] = slice(position, position + 1)
+        return self.table[tuple(selector)]
+
+    def count(self, **filters):
+        sub = self.slice(filters)
+        return 0 if sub is None else int(whole(sub.sum()))
+
+    def value_counts(self, column, **filters):
+        sub = self.slice(filters)
+        if sub is None:
+            return []
+        axis = self.axes[column]
+        counts = sub.sum(axis=tuple(i for i in range(sub.ndim) if i != axis))
+        return ranked_counts(whole(counts), self.sorted_values[column])
+
+# Categorical dimensions of the aggregate cube and the numeric measures summed in every cell
+CUBE_DIMENSIONS = ['Cluster', 'Gender', 'Customer_Region', 'Device_Used', 'Preferred_Payment_Method',
+                   'Product_Category', 'Age_Group', 'Engagement_Level']
+CUBE_MEASURES = PROFILE_MEAN_COLUMNS
+
+class AggregateCube(AggregateCounts):
+    """Dense cube of row counts and measure sums over every combination of the cube dimensions,
+    so any slice of the customers is answered from a few cells instead of a scan of the rows"""
+
+    def __init__(self, sorted_values, table, sums, appearance, columns=CUBE_DIMENSIONS, measures=CUBE_MEASURES):
+        # sums has the shape of table plus a trailing axis over `measures`; both may be memory-mapped
+        super().__init__(sorted_values, table, appearance, columns)
+        self.sums = sums
+        self.measures = list(measures)
+
+    @classmethod
+    def build(cls, df, columns=CUBE_DIMENSIONS, measures=CUBE_MEASURES, weights=None, values=None):
+        """Cube over a frame; `weights` scales each row and `values` fixes each column's value list"""
+        sorted_values, codes, appearance = {}, [], {}
+        for column in columns:
+            if values is None:
+                column_codes, uniques = pd.factorize(df[column], sort=True)
+                sorted_values[column] = np.asarray(uniques).tolist()
+            else:
+                sorted_values[column] = values[column]
+                column_codes = pd.Categorical(df[column], categories=values[column]).codes
+            appearance[column] = np.asarray(pd.unique(df[column])).tolist()
+            codes.append(column_codes)
+        shape = tuple(len(sorted_values[column]) for column in columns)
+        size = int(np.prod(shape))
+        flat = np.ravel_multi_index(codes, shape)
+        table = np.bincount(flat, weights=weights, minlength=size).reshape(shape)
+        scale = 1.0 if weights is None else weights
+        sums = np.stack([np.bincount(flat, weights=df[measure].to_numpy(dtype='float64') * scale, minlength=size)
+                         for measure in measures], axis=-1).reshape(shape + (len(measures),))
+        return cls(sorted_values, table, sums, appearance, columns, measures)
+
+    def rollup(self, filters, by=None):
+        """Counts and measure sums for rows matching `filters` (column -> list of accepted values).
+
+        Returns (count, sums per measure), or with `by` arrays of both over that column's values.
+        """
+        table, sums = self.table, self.sums
+        for column, values in filters.items():
+            positions = [self.positions[column][value] for value in values if value in self.positions[column]]
+            axis = self.axes[column]
+            table = np.take(table, positions, axis=axis)
+            sums = np.take(sums, positions, axis=axis)
+        if by is None:
+            return int(whole(table.sum())), sums.reshape(-1, len(self.measures)).sum(axis=0)
+        axis = self.axes[by]
+        others = tuple(i for i in range(table.ndim) if i != axis)
+        return whole(table.sum(axis=others)), sums.sum(axis=others)
+
+def aggregate_profiles(cube):
+    """Cluster profiles equivalent to build_cluster_profiles, computed from aggregates"""
+    profiles = {}
+    for cluster_id in cube.values('Cluster'):
+        size, sums = cube.rollup({'Cluster': [cluster_id]})
+        profiles[cluster_id] = {
+            'size': size,
+            'means': {column: float(sums[cube.measures.index(column)] / size) for column in PROFILE_MEAN_COLUMNS},
+            # ranked_counts breaks ties by value, matching Series.mode()
+            'modes': {column: cube.value_counts(column, Cluster=cluster_id)[0][0]
+                      for column in PROFILE_MODE_COLUMNS},
+            'breakdowns': {column: cube.value_counts(column, Cluster=cluster_id)
+                           for column in PROFILE_BREAKDOWN_COLUMNS},
+        }
+    return profiles
+
+# Entity Index
+# Every categorical value a message can name (products, regions, devices, payment methods, age groups,
+# engagement levels, genders and cluster ids), built once per snapshot.
+ENTITY_COLUMNS = ['Product_Category', 'Customer_Region', 'Device_Used', 'Preferred_Payment_Method',
+                  'Age_Group', 'Engagement_Level']
+# Extra phrases for values beyond their own names
+ENTITY_ALIASES = {
+    'Gender': {FEMALE: ["female", "females", "women", "woman"], MALE: ["male", "males", "men", "man"]},
+    'Device_Used': {'Mobile': ["phone", "phones", "smartphone", "smartphones"]},
+}
+# Words like "18-25" and "60+" stay single tokens; letters and digits split ("cluster2" -> cluster, 2)
+ENTITY_TOKEN = re.compile(r'\d+(?:-\d+|\+)?|[^\W\d_]+')
+ENTITY_END = ''  # trie key marking the end of a phrase
+KEYBOARD_ROWS = ["qwertyuiop", "asdfghjkl", "zxcvbnm"]
+# Keys touching each other on a QWERTY keyboard, with each row offset half a key from the one above
+KEYBOARD_NEIGHBOURS = {
+    key: {other for other_row, other_keys in enumerate(KEYBOARD_ROWS) for other_column, other in enumerate(other_keys)
+          if other != key and abs(other_row - row) <= 1 and abs(other_column + other_row / 2 - column - row / 2) <= 1}
+    for row, keys in enumerate(KEYBOARD_ROWS) for column, key in enumerate(keys)
+}
+# Words this long tolerate a dropped, extra or mistyped letter; shorter words only a swap, since any
+# other edit of a short word usually spells another word ("malls", "sorts", "table")
+LONG_WORD = 6
+
+def max_edits(word):
+    """Typos tolerated in a word: none for numbers or very short words"""
+    if not word.isalpha():
+        return 0
+    return 0 if len(word) < 5 else 1 if len(word) < 10 else 2
+
+def word_trigrams(word):
+    padded = f"  {word} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def edit_distance(a, b, limit):
+    """Cost of the typos turning a into b, or limit + 1 once it exceeds limit.
+
+    A swap of neighbouring letters costs 1 in any word. In long words, so does a dropped or extra letter
+    and a letter replaced by a neighbouring key; every other edit costs 2, which rules it out as a typo
+    of a single-edit word, since real words rarely differ from each other by a plausible slip of the hand.
+    """
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    gap = 1 if len(a) >= LONG_WORD else 2
+    before, previous = None, [j * gap for j in range(len(b) + 1)]
+    for i in range(1, len(a) + 1):
+        current = [i * gap] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            if a[i - 1] == b[j - 1]:
+                cost = 0
+            else:
+                cost = 1 if gap == 1 and b[j - 1] in KEYBOARD_NEIGHBOURS.get(a[i - 1], ()) else 2
+            current[j] = min(previous[j] + gap, current[j - 1] + gap, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], before[j - 2] + 1)
+        # A swap reaches back a row, so stop only once both rows are over the limit
+        if min(current) > limit and min(previous) >= limit:
+            return limit + 1
+        before, previous = previous, current
+    return previous[-1]
+
+class EntityMention:
+    """One entity named in a message; distance is the cost of the typos corrected to match it"""
+
+    def __init__(self, column, value, start, end, distance):
+        self.column = column
+        self.value = value
+        self.start = start
+        self.end = end
+        self.distance = distance
+
+class EntityIndex:
+    """Token trie over every entity phrase, with a trigram index for correcting misspelt words.
+
+    A message is tokenized once; each token is looked up as a vocabulary word, or corrected to the
+    closest one among the words sharing its trigrams, so lookups don't grow with the vocabulary.
+    """
+
+    def __init__(self, phrases):
+        self.trie = {}
+        for phrase, entity in phrases.items():
+            node = self.trie
+            for token in ENTITY_TOKEN.findall(phrase):
+                node = node.setdefault(token, {})
+            node.setdefault(ENTITY_END, entity)
+        self.words = {token for phrase in phrases for token in ENTITY_TOKEN.findall(phrase)}
+        self.parts = {}  # vocabulary word -> entities whose phrase contains it
+        for phrase, entity in phrases.items():
+            for token in ENTITY_TOKEN.findall(phrase):
+                if entity not in self.parts.setdefault(token, []):
+                    self.parts[token].append(entity)
+        self.part_lengths = sorted({len(word) for word in self.parts})
+        self.trigrams = {}  # trigram -> vocabulary words containing it
+        for word in self.words:
+            for gram in word_trigrams(word):
+                self.trigrams.setdefault(gram, set()).add(word)
+        # Messages repeat the same few words, so corrections are memoized per index
+        self.correct = functools.lru_cache(maxsize=4096)(self.closest_word)
+        self.contained = functools.lru_cache(maxsize=4096)(self.entities_within)
+
+    @classmethod
+    def build(cls, cube):
+        phrases = {}
+        for column in ENTITY_COLUMNS:
+            for value in cube.values(column):
+                phrases.setdefault(str(value).lower(), (column, value))
+        for column, aliases in ENTITY_ALIASES.items():
+            for value in cube.values(column):
+                for phrase in aliases.get(value, []):
+                    phrases.setdefault(phrase, (column, value))
+        for cluster_id in cube.values('Cluster'):
+            phrases[f"cluster {cluster_id}"] = ('Cluster', cluster_id)
+        return cls(phrases)
+
+    def closest_word(self, token):
+        """(vocabulary word, edits) for a token, or (None, 0) if nothing is close enough"""
+        if token in self.words:
+            return token, 0
+        limit = max_edits(token)
+        if not limit:
+            return None, 0
+        grams = word_trigrams(token)
+        shared = {}
+        for gram in grams:
+            for word in self.trigrams.get(gram, ()):
+                shared[word] = shared.get(word, 0) + 1
+        # Each edit changes at most four trigrams (a swap), which bounds the candidates worth checking
+        best, best_distance = None, limit + 1
+        for word in sorted(shared):
+            # Typos in the first letter are rare, and allowing them turns "worth" into "north"
+            if word[0] != token[0] or shared[word] < len(grams) - 4 * limit:
+                continue
+            distance = edit_distance(token, word, limit)
+            if distance < best_distance:
+                best, best_distance = word, distance
+        return (best, best_distance) if best is not None else (None, 0)
+
+    def entities_within(self, token):
+        """Entities with a phrase word inside the token ("sportswear" holds "sports"), by position"""
+        found = []
+        for start in range(len(token)):
+            for length in self.part_lengths:
+                if start + length > len(token):
+                    break
+                for entity in self.parts.get(token[start:start + length], ()):
+                    if entity not in found:
+                        found.append(entity)
+        return tuple(found)
+
+    def extract(self, text, partial=()):
+        """Every entity mentioned in the text, in order, taking the longest phrase at each position.
+
+        Words of the `partial` columns also match inside longer words, ahead of typo corrections.
+        """
+        tokens = list(ENTITY_TOKEN.finditer(text.lower()))
+        words = [self.correct(token.group()) for token in tokens]
+        mentions = []
+        i = 0
+        while i < len(tokens):
+            node, j, edits, found = self.trie, i, 0, None
+            while j < len(tokens) and words[j][0] in node:
+                node = node[words[j][0]]
+                edits += words[j][1]
+                j += 1
+                if ENTITY_END in node:
+                    found = (j, node[ENTITY_END], edits)
+            if found is None or found[2]:
+                token = tokens[i]
+                parts = [entity for entity in self.contained(token.group()) if entity[0] in partial] if partial else []
+                if parts:
+                    mentions.extend(EntityMention(column, value, token.start(), token.end(), 0)
+                                    for column, value in parts)
+                    i += 1
+                    continue
+            if found is None:
+                i += 1
+                continue
+            j, (column, value), edits = found
+            mentions.append(EntityMention(column, value, tokens[i].start(), tokens[j - 1].end(), edits))
+            i = j
+        return mentions
+
+SUMMARY_FORMAT_VERSION = 2
+
+def save_summary(path, snap):
+    """Write an aggregate snapshot to a compact .npz file other workers can load quickly"""
+    meta = {
+        'version': SUMMARY_FORMAT_VERSION,
+        'columns': snap.index.columns,
+        'values': snap.index.sorted_values,
+        'appearance': snap.index.appearance,
+        'measures': snap.cube.measures,
+        'rows': snap.rows,
+        'fingerprint': list(snap.fingerprint),
+        'digest': snap.digest,
+    }
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez_compressed(f, table=snap.cube.table, sums=snap.cube.sums, meta=np.array(json.dumps(meta)))
+    os.replace(tmp_path, path)
+
+def load_summary(path, source_path):
+    """Load a summary written by save_summary if it still describes `source_path`, else None"""
+    try:
+        with np.load(path, allow_pickle=False) as data:
+            meta = json.loads(str(data['meta']))
+            table, sums = data['table'], data['sums']
+    except (OSError, KeyError, ValueError):
+        return None
+    if meta.get('version') != SUMMARY_FORMAT_VERSION or meta['measures'] != CUBE_MEASURES \
+            or meta['columns'] != CUBE_DIMENSIONS:
+        return None
+    fingerprint = file_fingerprint(source_path)
+    if tuple(meta['fingerprint']) != fingerprint:
+        # Touched but maybe not changed: fall back to comparing content
+        if file_digest(source_path) != meta['digest']:
+            return None
+    # JSON turns integer values into ints already; keys of 'values' are column names
+    cube = AggregateCube(meta['values'], table, sums, meta['appearance'])
+    return AggregateSnapshot(cube, meta['rows'], fingerprint, meta['digest'])
+
+class AggregateSnapshot:
+    """Snapshot that holds only aggregates, for exports too large to keep as a frame"""
+
+    mode = 'aggregate'
+    df = None
+    centroids = None  # no rows to place centroids with
+    source = 'csv'
+
+    def __init__(self, cube, rows, fingerprint, digest):
+        # The cube's dimensions include every indexed column, so it answers the counting queries too
+        self.index = cube
+        self.cube = cube
+        self.entities = EntityIndex.build(cube)
+        self.rows = rows
+        self.profiles = aggregate_profiles(cube)
+        self.fingerprint = fingerprint
+        self.digest = digest
+        self.memory_bytes = int(cube.table.nbytes + cube.sums.nbytes)
+        self.loaded_at = datetime.now()
+        self.load_seconds = 0.0
+
+def build_aggregate_snapshot(path, summary_path=None):
+    """Load the summary file if it is current, otherwise stream the CSV and write a fresh one"""
+    if summary_path and os.path.exists(summary_path):
+        snap = load_summary(summary_path, path)
+        if snap is not None:
+            print(f"Loaded aggregate summary '{summary_path}'")
+            snap.source = 'summary hit'
+            return snap
+    fingerprint = file_fingerprint(path)
+    digest = file_digest(path)
+    cube, rows = stream_aggregates(path)
+    if file_fingerprint(path) != fingerprint:
+        raise RuntimeError(f"'{path}' changed while it was being loaded")
+    snap = AggregateSnapshot(cube, rows, fingerprint, digest)
+    if summary_path:
+        save_summary(summary_path, snap)
+        print(f"Wrote aggregate summary '{summary_path}'")
+    return snap
+
+SKETCH_COLUMNS = list(dict.fromkeys(PROFILE_MODE_COLUMNS + PROFILE_BREAKDOWN_COLUMNS))
+CONFIDENCE_Z = 1.96  # 95% confidence intervals for sampled means
+
+class SpaceSaving:
+    """Heavy-hitter sketch with at most `capacity` counters. A kept count overestimates the true
+    count by at most its error, and every value seen more than total/capacity times is kept."""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+
+    def add(self, value, count=1):
+        if value in self.counts:
+            self.counts[value] += count
+        elif len(self.counts) < self.capacity:
+            self.counts[value] = count
+            self.errors[value] = 0
+        else:
+            victim = min(self.counts, key=self.counts.get)
+            floor = self.counts.pop(victim)
+            del self.errors[victim]
+            self.counts[value] = floor + count
+            self.errors[value] = floor
+
+    def top(self):
+        """(value, count) pairs, most frequent first and ties in value order"""
+        values = sorted(self.counts)
+        return ranked_counts(np.array([self.counts[value] for value in values]), values)
+
+def stream_sample(path, sample_size=SAMPLE_SIZE, capacity=SKETCH_CAPACITY, seed=0, chunk_rows=CHUNK_ROWS):
+    """One pass over the CSV keeping exact cluster sizes, a uniform sample of up to `sample_size`
+    rows per cluster and a heavy-hitter sketch per cluster and categorical column"""
+    check_header(path)
+    # The sample keeps every column so it can also seed cluster assignment
+    columns = list(CSV_SCHEMA)
+    categorical = {column: 'category' for column in columns if CSV_SCHEMA[column] == 'category'}
+    rng = np.random.default_rng(seed)
+    sizes = {}  # cluster id -> rows
+    sketches = {}  # (cluster id, column) -> SpaceSaving
+    appearance = {column: {} for column in CUBE_DIMENSIONS}  # value -> first-seen order
+    sample = None
+    rows = 0
+    for chunk in pd.read_csv(path, usecols=columns, dtype=categorical, chunksize=chunk_rows):
+        chunk = apply_schema(chunk, columns)
+        for column in CUBE_DIMENSIONS:
+            seen = appearance[column]
+            for value in pd.unique(chunk[column]):
+                seen.setdefault(np.asarray(value).item(), len(seen))
+        for column in SKETCH_COLUMNS:
+            counts = chunk.groupby(['Cluster', column], observed=True).size()
+            for (cluster_id, value), count in zip(counts.index.tolist(), counts.tolist()):
+                cluster_id, value = to_native(cluster_id), to_native(value)
+                sketches.setdefault((cluster_id, column), SpaceSaving(capacity)).add(value, count)
+        for cluster_id, count in chunk['Cluster'].value_counts().items():
+            sizes[int(cluster_id)] = sizes.get(int(cluster_id), 0) + int(count)
+
+        # Bottom-k sampling: the rows with the smallest random keys in each cluster are a uniform
+        # sample without replacement, however the file is split into chunks
+        chunk = chunk.assign(_key=rng.random(len(chunk)))
+        candidates = chunk.sort_values('_key').groupby('Cluster', sort=False).head(sample_size)
+        candidates = candidates.astype({column: object for column in categorical})
+        sample = candidates if sample is None else pd.concat([sample, candidates], ignore_index=True)
+        sample = sample.sort_values('_key').groupby('Cluster', sort=False).head(sample_size)
+        rows += len(chunk)
+
+    sample = sample.drop(columns='_key').reset_index(drop=True)
+    order = {column: sorted(seen, key=seen.get) for column, seen in appearance.items()}
+    return sample, sizes, sketches, order, rows
+
+def approximate_profiles(sample, sizes, sketches):
+    """Cluster profiles from the samples and sketches, with a 95% margin of error for each mean"""
+    profiles = {}
+    for cluster_id, subset in sample.groupby('Cluster', sort=True):
+        cluster_id = int(cluster_id)
+        size, sampled = sizes[cluster_id], len(subset)
+        means = subset[PROFILE_MEAN_COLUMNS].mean()
+        # The finite population correction shrinks the margin to 0 once the whole cluster is sampled
+        errors = subset[PROFILE_MEAN_COLUMNS].std(ddof=1).fillna(0.0) / np.sqrt(sampled) \
+            * np.sqrt((size - sampled) / max(size - 1, 1))
+        profiles[cluster_id] = {
+            'size': size,
+            'sampled': sampled,
+            'means': {column: float(means[column]) for column in PROFILE_MEAN_COLUMNS},
+            'margins': {column: float(CONFIDENCE_Z * errors[column]) for column in PROFILE_MEAN_COLUMNS},
+            'modes': {column: sketches[(cluster_id, column)].top()[0][0] for column in PROFILE_MODE_COLUMNS},
+            'breakdowns': {column: sketches[(cluster_id, column)].top() for column in PROFILE_BREAKDOWN_COLUMNS},
+        }
+    return profiles
+
+class ExactNotReady(Exception):
+    """Exact figures were asked for while the exact aggregates are still being built"""
+
+class ApproximateSnapshot:
+    """Snapshot answering from per-cluster samples and sketches; an exact aggregate snapshot of
+    the same file is built in the background for requests that insist on exact figures"""
+
+    mode = 'approximate'
+    df = None
+    source = 'csv'
+
+    def __init__(self, sample, sizes, sketches, appearance, rows, path, fingerprint, digest):
+        self.sample = sample
+        self.rows = rows
+        self.path = path
+        # Counts and slices come from the sample with each row standing for size / sampled rows
+        # of its cluster, so every cluster is represented at its true size
+        sampled = sample['Cluster'].value_counts()
+        weights = sample['Cluster'].map({cluster_id: sizes[cluster_id] / sampled[cluster_id] for cluster_id in sizes})
+        self.weights = weights.to_numpy(dtype='float64')
+        values = {column: sorted(appearance[column]) for column in CUBE_DIMENSIONS}
+        self.cube = AggregateCube.build(sample, weights=self.weights, values=values)
+        self.cube.appearance = appearance
+        self.index = self.cube
+        self.entities = EntityIndex.build(self.cube)
+        self.profiles = approximate_profiles(sample, sizes, sketches)
+        self.fingerprint = fingerprint
+        self.digest = digest
+        self.memory_bytes = int(sample.memory_usage(index=False, deep=True).sum()
+                                + self.cube.table.nbytes + self.cube.sums.nbytes)
+        self.loaded_at = datetime.now()
+        self.load_seconds = 0.0
+        self.exact_snapshot = None
+        self.exact_error = None
+        self.exact_thread = None
+        self.exact_lock = threading.Lock()
+
+    @functools.cached_property
+    def centroids(self):
+        return ClusterCentroids.build(self.sample, weights=self.weights)
+
+    def start_exact(self):
+        """Build the exact aggregate snapshot in the background, reusing the summary file when it
+        is current. Threads don't survive fork, so this also restarts a build a worker lost."""
+        with self.exact_lock:
+            if self.exact_snapshot is not None or self.exact_error is not None:
+                return
+            if self.exact_thread is None or not self.exact_thread.is_alive():
+                self.exact_thread = threading.Thread(target=self.build_exact, name='exact-aggregates', daemon=True)
+                self.exact_thread.start()
+
+    def build_exact(self):
+        started = time.perf_counter()
+        try:
+            self.exact_snapshot = build_aggregate_snapshot(self.path, SUMMARY_FILE)
+        except Exception as e:
+            self.exact_error = e
+            print(f"ERROR building exact aggregates: {e}")
+            return
+        print(f"Exact aggregates ready in {time.perf_counter() - started:.1f}s")
+
+    def exact(self):
+        """Exact aggregate snapshot of the same export; raises ExactNotReady until it is built"""
+        if self.exact_snapshot is not None:
+            return self.exact_snapshot
+        if self.exact_error is not None:
+            raise ExactNotReady(f"Exact figures are unavailable: {self.exact_error}")
+        self.start_exact()
+        raise ExactNotReady("Exact figures are still being computed; try again shortly or ask without 'exact'")
+
+def build_approximate_snapshot(path):
+    """Sample the CSV in one streaming pass"""
+    fingerprint = file_fingerprint(path)
+    digest = file_digest(path)
+    # Seeding from the content hash gives every worker the same sample and so the same answers
+    sample, sizes, sketches, appearance, rows = stream_sample(path, seed=int(digest[:16], 16))
+    if file_fingerprint(path) != fingerprint:
+        raise RuntimeError(f"'{path}' changed while it was being loaded")
+    snap = ApproximateSnapshot(sample, sizes, sketches, appearance, rows, path, fingerprint, digest)
+    # Start on the exact aggregates now, so a request asking for them doesn't wait on a full scan
+    snap.start_exact()
+    return snap
+
+def file_fingerprint(path):
+    """Cheap change check: modification time and size"""
+    stat = os.stat(path)
+    return (stat.st_mtime_ns, stat.st_size)
+
+def file_digest(path):
+    """Content hash used to ignore touches that don't change the data"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def build_frame_snapshot(path):
+    """Parse the whole CSV into a frame and index it"""
+    fingerprint = file_fingerprint(path)
+    digest = file_digest(path)
+    df = read_clusters_csv(path)
+    if file_fingerprint(path) != fingerprint:
+        raise RuntimeError(f"'{path}' changed while it was being loaded")
+    return DataSnapshot(df, fingerprint, digest)
+
+SHARED_FORMAT_VERSION = 2
+# Changes whenever the schema or derived structures change, so snapshots written by other code
+# versions are never attached
+SHARED_LAYOUT = hashlib.sha256(json.dumps([
+    SHARED_FORMAT_VERSION, CSV_SCHEMA, INDEXED_COLUMNS, CUBE_DIMENSIONS, CUBE_MEASURES,
+    PROFILE_MEAN_COLUMNS, PROFILE_MODE_COLUMNS, PROFILE_BREAKDOWN_COLUMNS,
+]).encode()).hexdigest()[:8]
+
+def to_native(value):
+    """Plain Python scalar for JSON"""
+    return value.item() if isinstance(value, np.generic) else value
+
+def export_shared(snap, directory):
+    """Write a frame snapshot as raw .npy arrays plus JSON metadata that workers can memory-map"""
+    root = os.path.dirname(directory)
+    tmp = tempfile.mkdtemp(prefix='.building-', dir=root)
+    try:
+        columns = {}
+        for column in snap.df.columns:
+            series = snap.df[column]
+            if isinstance(series.dtype, pd.CategoricalDtype):
+                np.save(os.path.join(tmp, f"{column}.npy"), series.array.codes)
+                columns[column] = {'categories': series.cat.categories.tolist()}
+            else:
+                np.save(os.path.join(tmp, f"{column}.npy"), series.to_numpy())
+                columns[column] = {}
+        index = snap.index
+        for column in index.columns:
+            np.save(os.path.join(tmp, f"index.{column}.order.npy"), index.orders[column])
+            np.save(os.path.join(tmp, f"index.{column}.bounds.npy"), index.bounds[column])
+            np.save(os.path.join(tmp, f"index.{column}.codes.npy"), index.codes[column])
+        cube = snap.cube
+        np.save(os.path.join(tmp, "cube.table.npy"), cube.table)
+        np.save(os.path.join(tmp, "cube.sums.npy"), cube.sums)
+        profiles = {
+            str(cluster_id): {
+                'size': profile['size'],
+                'means': profile['means'],
+                'modes': {column: to_native(value) for column, value in profile['modes'].items()},
+                'breakdowns': {column: [[to_native(value), count] for value, count in pairs]
+                               for column, pairs in profile['breakdowns'].items()},
+            }
+            for cluster_id, profile in snap.profiles.items()
+        }
+        meta = {
+            'version': SHARED_FORMAT_VERSION,
+            'layout': SHARED_LAYOUT,
+            'digest': snap.digest,
+            'rows': snap.rows,
+            'columns': columns,
+            'index': {column: index.sorted_values[column] for column in index.columns},
+            'cube': {'columns': cube.columns, 'measures': cube.measures,
+                     'values': cube.sorted_values, 'appearance': cube.appearance},
+            'profiles': profiles,
+        }
+        with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        os.rename(tmp, directory)
+    except OSError:
+        shutil.rmtree(tmp, ignore_errors=True)
+        # Another worker finished exporting the same version first
+        if not os.path.isdir(directory):
+            raise
+    except Exception:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+
+def attach_shared(directory, fingerprint, digest=None):
+    """Snapshot whose frame and index are read-only views over memory-mapped files, after
+    checking the files are complete and describe `digest`; raises ValueError otherwise"""
+    with open(os.path.join(directory, 'meta.json')) as f:
+        meta = json.load(f)
+    if meta.get('version') != SHARED_FORMAT_VERSION or meta.get('layout') != SHARED_LAYOUT:
+        raise ValueError(f"'{directory}' was written by an incompatible version")
+    if digest is not None and meta['digest'] != digest:
+        raise ValueError(f"'{directory}' describes a different export")
+    if list(meta['columns']) != list(CSV_SCHEMA):
+        raise ValueError(f"'{directory}' doesn't have the declared columns")
+
+    def mapped(name, shape):
+        # Mapping only reads the header; a truncated file fails here rather than on first access
+        array = np.load(os.path.join(directory, name), mmap_mode='r')
+        if array.shape != shape:
+            raise ValueError(f"'{directory}/{name}' has shape {array.shape}, expected {shape}")
+        return array
+
+    rows = meta['rows']
+    data = {}
+    for column, info in meta['columns'].items():
+        values = mapped(f"{column}.npy", (rows,))
+        if 'categories' in info:
+            values = pd.Categorical.from_codes(values, info['categories'], validate=False)
+        data[column] = values
+    df = pd.DataFrame(data, copy=False)
+
+    sorted_values = meta['index']
+    index = RowIndex(sorted_values,
+                     {column: mapped(f"index.{column}.order.npy", (rows,)) for column in sorted_values},
+                     {column: mapped(f"index.{column}.bounds.npy", (len(values) + 1,))
+                      for column, values in sorted_values.items()},
+                     {column: mapped(f"index.{column}.codes.npy", (rows,)) for column in sorted_values})
+    cube_meta = meta['cube']
+    shape = tuple(len(cube_meta['values'][column]) for column in cube_meta['columns'])
+    cube = AggregateCube(cube_meta['values'], mapped("cube.table.npy", shape),
+                         mapped("cube.sums.npy", shape + (len(cube_meta['measures']),)),
+                         cube_meta['appearance'], cube_meta['columns'], cube_meta['measures'])
+    profiles = {
+        int(cluster_id): {
+            'size': profile['size'],
+            'means': profile['means'],
+            'modes': profile['modes'],
+            'breakdowns': {column: [tuple(pair) for pair in pairs] for column, pairs in profile['breakdowns'].items()},
+        }
+        for cluster_id, profile in meta['profiles'].items()
+    }
+    return DataSnapshot(df, fingerprint, meta['digest'], profiles=profiles, index=index, cube=cube)
+
+def build_shared_snapshot(path, root):
+    """Attach to the binary snapshot of the current CSV, parsing and exporting it only if no
+    worker has done so yet; snap.source records which happened. Falls back to the parsed CSV
+    when the snapshot directory can't be written, e.g. on a read-only data mount."""
+    try:
+        os.makedirs(root, exist_ok=True)
+    except OSError as e:
+        print(f"Can't use snapshot directory '{root}' ({e}); loading from the CSV")
+        return build_frame_snapshot(path)
+    pointer_path = os.path.join(root, 'current.json')
+    fingerprint = file_fingerprint(path)
+    # Fast path: the file hasn't been touched since the pointer was written, so skip hashing it
+    try:
+        with open(pointer_path) as f:
+            pointer = json.load(f)
+        directory = os.path.join(root, pointer['directory'])
+        if tuple(pointer['fingerprint']) == fingerprint:
+            snap = attach_shared(directory, fingerprint, pointer['digest'])
+            snap.source = 'snapshot hit'
+            return snap
+    except (OSError, ValueError, KeyError):
+        pass
+
+    digest = file_digest(path)
+    directory = os.path.join(root, f"{digest[:16]}-{SHARED_LAYOUT}")
+    snap = None
+    if os.path.isdir(directory):
+        try:
+            snap = attach_shared(directory, fingerprint, digest)
+            snap.source = 'snapshot hit'
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Discarding unusable snapshot '{directory}': {e}")
+            shutil.rmtree(directory, ignore_errors=True)
+    if snap is None:
+        parsed = build_frame_snapshot(path)
+        if parsed.digest != digest:
+            raise RuntimeError(f"'{path}' changed while it was being loaded")
+        try:
+            export_shared(parsed, directory)
+        except OSError as e:
+            print(f"Couldn't export shared snapshot to '{directory}' ({e}); serving the parsed CSV")
+            return parsed
+        print(f"Exported shared snapshot to '{directory}'")
+        snap = attach_shared(directory, fingerprint, digest)
+        snap.source = 'snapshot rebuilt'
+    try:
+        tmp_pointer = f"{pointer_path}.{os.getpid()}.tmp"
+        with open(tmp_pointer, 'w') as f:
+            json.dump({'fingerprint': list(fingerprint), 'digest': digest, 'directory': os.path.basename(directory)}, f)
+        os.replace(tmp_pointer, pointer_path)
+        prune_shared(root, keep=SHARED_KEEP_VERSIONS)
+    except OSError as e:
+        # The snapshot is usable; the next start just hashes the CSV again to find it
+        print(f"Couldn't update snapshot pointer in '{root}': {e}")
+    return snap
+
+def prune_shared(root, keep):
+    """Remove all but the newest `keep` exported versions; mapped files stay valid until unmapped"""
+    versions = [os.path.join(root, name) for name in os.listdir(root)
+                if not name.startswith('.') and os.path.isdir(os.path.join(root, name))]
+    versions.sort(key=os.path.getmtime, reverse=True)
+    for directory in versions[keep:]:
+        shutil.rmtree(directory, ignore_errors=True)
+
+def build_snapshot(path=DATA_FILE):
+    """Parse the CSV and build its derived indexes without touching the live snapshot"""
+    started = time.perf_counter()
+    if DATA_MODE == 'aggregate':
+        snap = build_aggregate_snapshot(path, SUMMARY_FILE)
+    elif DATA_MODE == 'approximate':
+        snap = build_approximate_snapshot(path)
+    elif SHARED_DATA_DIR:
+        snap = build_shared_snapshot(path, SHARED_DATA_DIR)
+    else:
+        snap = build_frame_snapshot(path)
+    snap.load_seconds = time.perf_counter() - started
+    return snap
+
+def install_snapshot(snap):
+    """Make a snapshot live; handlers pick it up on their next request"""
+    global dataset, df_clusters
+    dataset = snap
+    df_clusters = snap.df
+    # Cached answers describe the old data; keys also carry the digest in case a request
+    # pinned to the old snapshot finishes after this point
+    response_cache.clear()
+    metrics.inc('chatbot_dataset_snapshots_installed_total')
+
 def load_data():
-    global df_clusters
     try:
-        df_clusters = pd.read_csv("ecommerce_customer_clusters_for_tableau.csv")
+        snap = build_snapshot(DATA_FILE)
+        install_snapshot(snap)
         print("Data loaded successfully!")
-        print(f"Loaded {len(df_clusters)} records with {len(df_clusters.columns)} columns")
+        print(f"Data ready in {snap.load_seconds:.3f}s ({snap.source})")
+        if snap.df is not None:
+            print(f"Loaded {snap.rows} records with {len(snap.df.columns)} columns")
+            report_memory_usage(snap.df)
+        elif snap.mode == 'approximate':
+            print(f"Sampled {len(snap.sample)} of {snap.rows} records "
+                  f"({snap.memory_bytes / 1024:.1f} KB)")
+        else:
+            print(f"Aggregated {snap.rows} records into {snap.index.table.size} groups "
+                  f"({snap.memory_bytes / 1024:.1f} KB)")
         return True
     except FileNotFoundError:
-        print("ERROR: CSV file 'ecommerce_customer_clusters_for_tableau.csv' not found.")
+        print(f"ERROR: CSV file '{DATA_FILE}' not found.")
         print("Please ensure the CSV file is in the same directory as this script.")
         return False
     except Exception as e:
         print(f"ERROR loading data: {e}")
         return False
 
+class DatasetReloader(threading.Thread):
+    """Background thread that rebuilds the snapshot when a new CSV export lands"""
+
+    def __init__(self, path, interval):
+        super().__init__(name='dataset-reloader', daemon=True)
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+        # Fingerprint of an export that failed to load, so it isn't retried every tick
+        self.rejected = None
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.check()
+            except Exception as e:
+                print(f"ERROR reloading data, keeping the current snapshot: {e}")
+
+    def check(self):
+        current = dataset
+        try:
+            fingerprint = file_fingerprint(self.path)
+        except FileNotFoundError:
+            return
+        if fingerprint in (current.fingerprint, self.rejected):
+            return
+        if file_digest(self.path) == current.digest:
+            current.fingerprint = fingerprint
+            return
+        try:
+            snap = build_snapshot(self.path)
+        except Exception:
+            self.rejected = fingerprint
+            raise
+        install_snapshot(snap)
+        print(f"Data reloaded: {snap.rows} records from '{self.path}'")
+
+# Metrics
+# Latency histograms and dataset gauges, exposed in Prometheus text format on /metrics
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', '0'))  # 0 disables the slow-query log
+SLOW_QUERY_LOG = os.environ.get('SLOW_QUERY_LOG')  # file to append to; printed when unset
+
+METRIC_HELP = {
+    'chatbot_request_seconds': "Time to answer a chat message, by resolved intent",
+    'chatbot_handler_seconds': "Time spent in each response handler",
+    'chatbot_intent_match_seconds': "Time spent classifying a message",
+    'chatbot_session_seconds': "Time spent loading and saving server-side sessions",
+    'chatbot_response_serialize_seconds': "Time spent serialising chat responses to JSON",
+}
+
+class Histogram:
+    """Cumulative-bucket latency histogram"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Metrics:
+    """Registry of labelled histograms and counters"""
+
+    def __init__(self):
+        self.histograms = {}  # (name, labels) -> Histogram
+        self.counters = {}    # (name, labels) -> value
+        self.lock = threading.Lock()
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    @contextmanager
+    def timer(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def render(self):
+        """Prometheus text exposition of everything recorded so far"""
+        with self.lock:
+            histograms = {key: (list(h.counts), h.sum, h.count) for key, h in self.histograms.items()}
+            counters = dict(self.counters)
+        lines = []
+        seen = set()
+        for (name, labels), (counts, total, count) in sorted(histograms.items()):
+            if name not in seen:
+                seen.add(name)
+                lines.append(f"# HELP {name} {METRIC_HELP.get(name, name)}")
+                lines.append(f"# TYPE {name} histogram")
+            cumulative = 0
+            for bound, bucket_count in zip(LATENCY_BUCKETS + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', le),))} {cumulative}")
+            lines.append(f"{name}_sum{format_labels(labels)} {total}")
+            lines.append(f"{name}_count{format_labels(labels)} {count}")
+        for (name, labels), value in sorted(counters.items()):
+            if name not in seen:
+                seen.add(name)
+                lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name}{format_labels(labels)} {value}")
+        return '\n'.join(lines) + '\n'
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+def timed(handler_name):
+    """Decorator recording a handler's latency under chatbot_handler_seconds"""
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with metrics.timer('chatbot_handler_seconds', handler=handler_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def log_slow_query(message, intent, elapsed):
+    """Record a message that took longer than SLOW_QUERY_MS to answer"""
+    entry = json.dumps({'time': datetime.now().isoformat(timespec='seconds'), 'ms': round(elapsed * 1000, 3),
+                        'intent': intent, 'message': message})
+    if SLOW_QUERY_LOG:
+        with open(SLOW_QUERY_LOG, 'a') as f:
+            f.write(entry + '\n')
+    else:
+        print(f"SLOW QUERY: {entry}")
+
+def dataset_gauges():
+    """(name, type, help, value) for the live snapshot and the response cache"""
+    snap = dataset
+    cache = response_cache.stats()
+    return [
+        ('chatbot_dataset_rows', 'gauge', "Rows in the live dataset", snap.rows),
+        ('chatbot_dataset_memory_bytes', 'gauge', "In-memory size of the live dataset", snap.memory_bytes),
+        ('chatbot_dataset_load_seconds', 'gauge', "Time taken to build the live snapshot", snap.load_seconds),
+        ('chatbot_dataset_snapshot_hit', 'gauge', "1 if the live dataset was loaded from an existing binary "
+         "snapshot or summary instead of the CSV", int(snap.source.endswith('hit'))),
+        ('chatbot_dataset_loaded_timestamp_seconds', 'gauge', "When the live snapshot was installed",
+         snap.loaded_at.timestamp()),
+        ('chatbot_response_cache_entries', 'gauge', "Entries in the response cache", cache['size']),
+        ('chatbot_response_cache_hits_total', 'counter', "Response cache hits", cache['hits']),
+        ('chatbot_response_cache_misses_total', 'counter', "Response cache misses", cache['misses']),
+    ]
+
+metrics = Metrics()
+
+# Response Cache
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', '1024'))
+RESPONSE_CACHE_TTL = float(os.environ.get('RESPONSE_CACHE_TTL', '300'))  # seconds
+
+class ResponseCache:
+    """Thread-safe LRU cache with a time-to-live and hit/miss counters"""
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (expires_at, value)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        if self.max_size <= 0:
+            return
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self.entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL)
+
 # Initialize data on startup
 if not load_data():
     print("Application cannot start without the required CSV file.")
     exit(1)
 
+def start_dataset_reloader():
+    """Start watching for new exports in this process"""
+    global dataset_reloader
+    dataset_reloader = DatasetReloader(DATA_FILE, RELOAD_INTERVAL)
+    dataset_reloader.start()
+
+dataset_reloader = None
+if RELOAD_INTERVAL > 0:
+    start_dataset_reloader()
+    # Threads don't survive fork, so workers forked from a preloaded master (gunicorn --preload)
+    # each start their own reloader
+    if hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_child=start_dataset_reloader)
+
+def resume_exact_build():
+    """Restart the exact aggregate build in a forked worker, whose copy of the build thread is gone"""
+    if dataset.mode == 'approximate':
+        dataset.exact_lock = threading.Lock()
+        dataset.start_exact()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=resume_exact_build)
+
 # Helper Functions
-def get_cluster_info(cluster_id):
+APPROXIMATE_NOTE = "≈ *Estimated from a sample of each cluster*"
+
+def margin(profile, column, value_format):
+    """' ± margin' for a mean estimated from a sample, empty for exact profiles"""
+    margins = profile.get('margins')
+    if not margins:
+        return ""
+    return " ± " + value_format.format(margins[column])
+
+@timed('get_cluster_info')
+def get_cluster_info(cluster_id, snap=None, state=None):
     """Get detailed information about a specific cluster"""
-    subset = df_clusters[df_clusters['Cluster'] == cluster_id]
-    if subset.empty:
+    snap = snap or dataset
+    state = session if state is None else state
+    profile = snap.profiles.get(cluster_id)
+    if profile is None:
         return f"Cluster {cluster_id} doesn't exist in the data."
     
-    session['last_cluster'] = cluster_id
+    state['last_cluster'] = cluster_id
     
-    # Calculate statistics
-    avg_income = subset['Annual_Income'].mean()
-    avg_spend = subset['Spending_Score'].mean()
-    avg_order_value = subset['Average_Order_Value'].mean()
-    avg_orders = subset['Number_of_Orders'].mean()
-    avg_review = subset['Review_Score'].mean()
-    avg_age = subset['Age'].mean()
+    means = profile['means']
+    modes = profile['modes']
+    avg_income = means['Annual_Income']
+    avg_spend = means['Spending_Score']
+    avg_order_value = means['Average_Order_Value']
+    avg_orders = means['Number_of_Orders']
+    avg_review = means['Review_Score']
+    avg_age = means['Age']
     
-    # Get most common values
-    top_device = subset['Device_Used'].mode()[0] if not subset['Device_Used'].mode().empty else "N/A"
-    top_payment = subset['Preferred_Payment_Method'].mode()[0] if not subset['Preferred_Payment_Method'].mode().empty else "N/A"
-    top_product = subset['Product_Category'].mode()[0] if not subset['Product_Category'].mode().empty else "N/A"
-    top_region = subset['Customer_Region'].mode()[0] if not subset['Customer_Region'].mode().empty else "N/A"
+    top_device = modes['Device_Used']
+    top_payment = modes['Preferred_Payment_Method']
+    top_product = modes['Product_Category']
+    top_region = modes['Customer_Region']
     
-    cluster_size = len(subset)
+    cluster_size = profile['size']
     
     return (
         f"### Cluster {cluster_id} Overview ({cluster_size} customers)\n"
-        f"• **Average Income:** ${avg_income:,.2f}\n"
-        f"• **Spending Score:** {avg_spend:.1f}/100\n"
-        f"• **Avg Order Value:** ${avg_order_value:.2f}\n"
-        f"• **Orders per Customer:** {avg_orders:.1f}\n"
-        f"• **Average Review Score:** {avg_review:.2f}/5.0\n"
-        f"• **Average Age:** {avg_age:.1f} years\n"
+        f"• **Average Income:** ${avg_income:,.2f}{margin(profile, 'Annual_Income', '${:,.2f}')}\n"
+        f"• **Spending Score:** {avg_spend:.1f}/100{margin(profile, 'Spending_Score', '{:.1f}')}\n"
+        f"• **Avg Order Value:** ${avg_order_value:.2f}{margin(profile, 'Average_Order_Value', '${:.2f}')}\n"
+        f"• **Orders per Customer:** {avg_orders:.1f}{margin(profile, 'Number_of_Orders', '{:.1f}')}\n"
+        f"• **Average Review Score:** {avg_review:.2f}/5.0{margin(profile, 'Review_Score', '{:.2f}')}\n"
+        f"• **Average Age:** {avg_age:.1f} years{margin(profile, 'Age', '{:.1f}')}\n"
         f"• **Most Common Payment:** {top_payment}\n"
         f"• **Most Used Device:** {top_device}\n"
         f"• **Popular Product Category:** {top_product}\n"
@@ -69,42 +1388,43 @@ def get_cluster_info(cluster_id):
         f"💡 *Ask about specific aspects like 'income', 'spending', or 'devices' for more details*"
     )
 
-def product_cluster_response(user_input):
+@timed('product_cluster_response')
+def product_cluster_response(user_input, snap=None, state=None, match=None):
     """Find which cluster is most associated with a product category"""
-    user_input_lower = user_input.lower()
-    product_categories = df_clusters['Product_Category'].unique()
+    snap = snap or dataset
+    state = session if state is None else state
+    match = match or intent_router.scan(user_input)
     matched_product = None
+    corrected = None
 
-    # Find matching product category
-    for product in product_categories:
-        if product.lower() in user_input_lower:
-            matched_product = product
-            break
-    
-    # Also check for partial matches
-    if not matched_product:
-        for product in product_categories:
-            product_words = product.lower().split()
-            if any(word in user_input_lower for word in product_words):
-                matched_product = product
-                break
+    # Find matching product category, preferring exact mentions, then the data's order of appearance
+    mentions = [mention for mention in snap.entities.extract(user_input, partial=('Product_Category',))
+                if mention.column == 'Product_Category']
+    # A corrected typo is only a guess, so it mustn't take over a follow-up about the last cluster
+    if state.get('last_cluster') is not None and any(match.has(words) for words in FOLLOW_UP_WORDS.values()):
+        mentions = [mention for mention in mentions if not mention.distance]
+    if mentions:
+        order = {product: i for i, product in enumerate(snap.index.appearance['Product_Category'])}
+        best = min(mentions, key=lambda mention: (mention.distance, order.get(mention.value, len(order))))
+        matched_product = best.value
+        if best.distance:
+            corrected = user_input.lower()[best.start:best.end]
 
     if matched_product:
-        filtered = df_clusters[df_clusters['Product_Category'] == matched_product]
+        total_customers = snap.index.count(Product_Category=matched_product)
         
-        if filtered.empty:
+        if not total_customers:
             return f"No data found for product category '{matched_product}'"
         
-        cluster_counts = filtered['Cluster'].value_counts().sort_values(ascending=False)
-        top_cluster = int(cluster_counts.idxmax())
-        count = int(cluster_counts.max())
-        total_customers = len(filtered)
+        top_cluster, count = snap.index.value_counts('Cluster', Product_Category=matched_product)[0]
 
-        session['last_cluster'] = int(top_cluster)
-        session['last_product'] = str(matched_product)
+        state['last_cluster'] = int(top_cluster)
+        state['last_product'] = str(matched_product)
 
+        # Say how a misspelt word was read, so a wrong guess is visible
+        note = f" *(reading '{corrected}' as {matched_product})*" if corrected else ""
         return (
-            f"**{matched_product} Analysis:**\n"
+            f"**{matched_product} Analysis:**{note}\n"
             f"• **Top Cluster:** Cluster {top_cluster} ({count} customers)\n"
             f"• **Total Customers:** {total_customers} purchase this category\n"
             f"💡 Ask: *'Tell me about Cluster {top_cluster}'* to learn more about these customers."
@@ -112,117 +1432,112 @@ def product_cluster_response(user_input):
     
     return None
 
-def follow_up_on_last_cluster(user_input):
+@timed('follow_up_on_last_cluster')
+def follow_up_on_last_cluster(user_input, snap=None, match=None, state=None):
     """Handle follow-up questions about the last discussed cluster"""
-    msg = user_input.lower()
-    cluster_id = session.get('last_cluster')
+    snap = snap or dataset
+    match = match or intent_router.scan(user_input)
+    state = session if state is None else state
+    cluster_id = state.get('last_cluster')
     
     if cluster_id is None:
         return None
     
-    subset = df_clusters[df_clusters["Cluster"] == cluster_id]
+    profile = snap.profiles.get(cluster_id)
     
-    if subset.empty:
+    if profile is None:
         return None
+    
+    means = profile['means']
+    breakdowns = profile['breakdowns']
+    cluster_size = profile['size']
 
     # Handle different types of follow-up questions
-    if any(word in msg for word in ["income", "salary", "earn", "money"]):
-        avg_income = subset['Annual_Income'].mean()
+    if match.has(FOLLOW_UP_WORDS['income']):
+        avg_income = means['Annual_Income']
         return (f"💰 **Cluster {cluster_id} Income Details:**\n"
-                f"• Average: ${avg_income:,.2f}")
+                f"• Average: ${avg_income:,.2f}{margin(profile, 'Annual_Income', '${:,.2f}')}")
     
-    elif any(word in msg for word in ["spend", "spending", "score"]):
-        avg_spend = subset['Spending_Score'].mean()
+    elif match.has(FOLLOW_UP_WORDS['spending']):
+        avg_spend = means['Spending_Score']
         return (f"📊 **Cluster {cluster_id} Spending Details:**\n"
-                f"• Average: {avg_spend:.1f}/100")
+                f"• Average: {avg_spend:.1f}/100{margin(profile, 'Spending_Score', '{:.1f}')}")
     
-    elif any(word in msg for word in ["order", "orders", "purchase"]):
-        avg_orders = subset['Number_of_Orders'].mean()
-        avg_value = subset['Average_Order_Value'].mean()
+    elif match.has(FOLLOW_UP_WORDS['orders']):
+        avg_orders = means['Number_of_Orders']
+        avg_value = means['Average_Order_Value']
         return (f"🛒 **Cluster {cluster_id} Order Patterns:**\n"
-                f"• Average orders per customer: **{avg_orders:.1f}**\n"
-                f"• Average order value: **${avg_value:.2f}**")
+                f"• Average orders per customer: **{avg_orders:.1f}**{margin(profile, 'Number_of_Orders', '{:.1f}')}\n"
+                f"• Average order value: **${avg_value:.2f}**{margin(profile, 'Average_Order_Value', '${:.2f}')}")
     
-    elif any(word in msg for word in ["review", "rating", "satisfaction"]):
-        avg_review = subset['Review_Score'].mean()
+    elif match.has(FOLLOW_UP_WORDS['reviews']):
+        avg_review = means['Review_Score']
         return (f"⭐ **Cluster {cluster_id} Review Details:**\n"
-                f"• Average: {avg_review:.2f}/5.0")
+                f"• Average: {avg_review:.2f}/5.0{margin(profile, 'Review_Score', '{:.2f}')}")
     
-    elif any(word in msg for word in ["device", "mobile", "desktop", "tablet"]):
-        device_counts = subset['Device_Used'].value_counts()
+    elif match.has(FOLLOW_UP_WORDS['devices']):
+        device_counts = breakdowns['Device_Used']
         device_info = "📱 **Cluster " + str(cluster_id) + " Device Usage:**\n"
-        for device, count in device_counts.items():
-            percentage = (count / len(subset)) * 100
+        for device, count in device_counts:
+            percentage = (count / cluster_size) * 100
             device_info += f"• {device}: {count} customers ({percentage:.1f}%)\n"
         return device_info
     
-    elif any(word in msg for word in ["region", "location", "where"]):
-        region_counts = subset['Customer_Region'].value_counts()
+    elif match.has(FOLLOW_UP_WORDS['regions']):
+        region_counts = breakdowns['Customer_Region']
         region_info = "🌍 **Cluster " + str(cluster_id) + " Regional Distribution:**\n"
-        for region, count in region_counts.items():
-            percentage = (count / len(subset)) * 100
+        for region, count in region_counts:
+            percentage = (count / cluster_size) * 100
             region_info += f"• {region}: {count} customers ({percentage:.1f}%)\n"
         return region_info
     
-    elif any(word in msg for word in ["gender", "male", "female"]):
-        gender_counts = subset['Gender'].value_counts()
+    elif match.has(FOLLOW_UP_WORDS['gender']):
+        gender_counts = breakdowns['Gender']
         gender_info = "👥 **Cluster " + str(cluster_id) + " Gender Distribution:**\n"
-        for gender, count in gender_counts.items():
-            percentage = (count / len(subset)) * 100
+        for gender, count in gender_counts:
+            percentage = (count / cluster_size) * 100
             # Convert numeric gender codes to readable labels
             gender_label = "Male" if gender == 1 else "Female" if gender == 0 else str(gender)
             gender_info += f"• {gender_label}: {count} customers ({percentage:.1f}%)\n"
         return gender_info
     
-    elif any(word in msg for word in ["age", "old", "young"]):
-        avg_age = subset['Age'].mean()
+    elif match.has(FOLLOW_UP_WORDS['age']):
+        avg_age = means['Age']
         return (f"👨‍👩‍👧‍👦 **Cluster {cluster_id} Age Details:**\n"
-                f"• Average age: **{avg_age:.1f} years**")
+                f"• Average age: **{avg_age:.1f} years**{margin(profile, 'Age', '{:.1f}')}")
     
     return None
 
-def gender_product_analysis(user_input):
+@timed('gender_product_analysis')
+def gender_product_analysis(user_input, snap=None, match=None):
     """Analyze product preferences by gender, optionally within a specific cluster"""
-    input_lower = user_input.lower()
+    snap = snap or dataset
+    match = match or intent_router.scan(user_input)
     
     # Check if a specific cluster is mentioned
-    import re
-    cluster_matches = re.findall(r'cluster\s+(\d+)', input_lower)
-    cluster_id = None
-    if cluster_matches:
-        try:
-            cluster_id = int(cluster_matches[0])
-        except ValueError:
-            pass
-
+    cluster_id = match.cluster_number
     
     # Start with all data or filter by cluster
-    data_subset = df_clusters
+    filters = {}
     cluster_text = ""
     if cluster_id is not None:
-        available_clusters = [int(x) for x in df_clusters['Cluster'].unique()]
+        available_clusters = list(snap.profiles)
         if cluster_id not in available_clusters:
             available_clusters_str = ', '.join(map(str, sorted(available_clusters)))
             return f"Cluster {cluster_id} doesn't exist. Available clusters: {available_clusters_str}"
         
-        data_subset = df_clusters[df_clusters['Cluster'] == cluster_id]
+        filters['Cluster'] = cluster_id
         cluster_text = f" in Cluster {cluster_id}"
     
     # Check if asking about female preferences FIRST to avoid "female" being caught by "male"
-    if any(word in input_lower for word in ["female", "women", "woman"]):
-        # Filter for females
-        female_customers = data_subset[data_subset['Gender'] == 0]  # Adjust based on your data encoding
-        
-        if female_customers.empty:
-            # Try alternative encoding
-            female_customers = data_subset[data_subset['Gender'].str.lower() == 'female'] if data_subset['Gender'].dtype == 'object' else data_subset[data_subset['Gender'] == 'Female']
+    if match.has(FEMALE_WORDS):
+        total_females = snap.index.count(Gender=FEMALE, **filters)
         
-        if not female_customers.empty:
-            product_counts = female_customers['Product_Category'].value_counts()
-            total_females = len(female_customers)
+        if total_females:
+            product_counts = snap.index.value_counts('Product_Category', Gender=FEMALE, **filters)
             
             response = f"👩 **Female Customer Product Preferences{cluster_text}** ({total_females} customers):\n"
-            for product, count in product_counts.head(5).items():  # Top 5 products
+            for product, count in product_counts[:5]:  # Top 5 products
                 percentage = (count / total_females) * 100
                 response += f"• **{product}**: {count} customers ({percentage:.1f}%)\n"
             return response
@@ -233,20 +1548,14 @@ def gender_product_analysis(user_input):
                 return f"No female customers found in the data"
     
     # Check if asking about male preferences
-    elif any(word in input_lower for word in ["male", "men", "man"]) and not any(word in input_lower for word in ["female", "women", "woman"]):
-        # Filter for males (assuming 1 = Male, 0 = Female, or check actual values)
-        male_customers = data_subset[data_subset['Gender'] == 1]  # Adjust based on your data encoding
+    elif match.has(MALE_WORDS):
+        total_males = snap.index.count(Gender=MALE, **filters)
         
-        if male_customers.empty:
-            # Try alternative encoding
-            male_customers = data_subset[data_subset['Gender'].str.lower() == 'male'] if data_subset['Gender'].dtype == 'object' else data_subset[data_subset['Gender'] == 'Male']
-        
-        if not male_customers.empty:
-            product_counts = male_customers['Product_Category'].value_counts()
-            total_males = len(male_customers)
+        if total_males:
+            product_counts = snap.index.value_counts('Product_Category', Gender=MALE, **filters)
             
             response = f"👨 **Male Customer Product Preferences{cluster_text}** ({total_males} customers):\n"
-            for product, count in product_counts.head(5).items():  # Top 5 products
+            for product, count in product_counts[:5]:  # Top 5 products
                 percentage = (count / total_males) * 100
                 response += f"• **{product}**: {count} customers ({percentage:.1f}%)\n"
             return response
@@ -258,179 +1567,1023 @@ def gender_product_analysis(user_input):
     
     return None
 
-def cluster_aware_response(user_input):
-    """Main function to handle user queries and return appropriate responses"""
-    input_lower = user_input.lower().strip()
-
-    # Handle greetings
-    greeting_words = ["hello", "hi", "hey"]
-    if any(input_lower.startswith(greeting) or f" {greeting}" in input_lower for greeting in greeting_words):
-        return ("👋 **Hello!** I'm your customer cluster analysis assistant.\n"
-                "I can help you explore customer segments. Try asking:\n"
-                "• *'Tell me about Cluster 0'*\n"
-                "• *'Which cluster buys electronics?'*\n"
-                "• *'Show me available clusters'*")
-
-    # Handle gender-based product queries
-    gender_response = gender_product_analysis(user_input)
-    if gender_response:
-        return gender_response
-
-    
-    # Handle help requests
-    if any(word in input_lower for word in ["help", "what can you do", "commands", "options"]):
-        available_clusters = [int(x) for x in sorted(df_clusters['Cluster'].unique())]
-        available_products = sorted(df_clusters['Product_Category'].unique())
-        
-        return ("🤖 **I can help you with:**\n"
-                "**Cluster Analysis:**\n"
-                f"• Available clusters: {', '.join(map(str, available_clusters))}\n"
-                "• Ask: *'Tell me about Cluster X'*\n"
-                "**Product Analysis:**\n"
-                f"• Categories: {', '.join(available_products)}\n"
-                "• Ask: *'Which cluster buys electronics?'*\n"
-                "**Follow-up Questions:**\n"
-                "• Income, spending, age, devices, regions, etc.")
-
-    # Handle cluster queries
-    if "cluster" in input_lower:
-        # Extract cluster number if mentioned
-        import re
-        cluster_matches = re.findall(r'\b(\d+)\b', user_input)
-        
-        if cluster_matches:
-            try:
-                cluster_id = int(cluster_matches[0])
-                available_clusters = [int(x) for x in df_clusters['Cluster'].unique()]
-                if cluster_id in available_clusters:
-                    return get_cluster_info(cluster_id)
-                else:
-                    available_clusters_str = ', '.join(map(str, sorted(available_clusters)))
-                    return f"Cluster {cluster_id} doesn't exist. Available clusters: {available_clusters_str}"
-            except ValueError:
-                pass
-        
-        # Show available clusters if no specific number mentioned
-        if any(phrase in input_lower for phrase in ["available", "show", "list", "what clusters"]):
-            available_clusters = [int(x) for x in sorted(df_clusters['Cluster'].unique())]
-            cluster_info = "**Available Customer Clusters:**\n"
-            for cluster_id in available_clusters:
-                cluster_size = len(df_clusters[df_clusters['Cluster'] == cluster_id])
-                cluster_info += f"• **Cluster {cluster_id}** ({cluster_size} customers)\n"
-            cluster_info += "💡 *Ask about any specific cluster for detailed analysis*"
-            return cluster_info
-
-    # Handle product category queries
-    if any(phrase in input_lower for phrase in ["product", "category", "categories", "available product", "what product"]):
-        if any(phrase in input_lower for phrase in ["available", "show", "list", "what are"]):
-            categories = sorted(df_clusters['Product_Category'].unique())
-            category_info = "**Available Product Categories:**\n"
-            for category in categories:
-                count = len(df_clusters[df_clusters['Product_Category'] == category])
-                category_info += f"• **{category}** ({count} customers)\n"
-            return category_info
-
-    # Handle payment method queries
-    if any(word in input_lower for word in ["payment", "pay"]):
-        payments = sorted(df_clusters['Preferred_Payment_Method'].unique())
-        payment_info = "**Customer Payment Methods:**\n"
-        for payment in payments:
-            count = len(df_clusters[df_clusters['Preferred_Payment_Method'] == payment])
-            payment_info += f"• **{payment}** ({count} customers)\n"
-        return payment_info
-    
-    # Handle device queries
-    if any(word in input_lower for word in ["device", "mobile", "desktop", "tablet"]):
-        devices = sorted(df_clusters['Device_Used'].unique())
-        device_info = "📱 **Customer Device Usage:**\n"
-        for device in devices:
-            count = len(df_clusters[df_clusters['Device_Used'] == device])
-            device_info += f"• **{device}** ({count} customers)\n"
-        return device_info
+def greeting_response():
+    """Introduce the assistant"""
+    return ("👋 **Hello!** I'm your customer cluster analysis assistant.\n"
+            "I can help you explore customer segments. Try asking:\n"
+            "• *'Tell me about Cluster 0'*\n"
+            "• *'Which cluster buys electronics?'*\n"
+            "• *'Show me available clusters'*")
 
-    # Handle region queries
-    if any(word in input_lower for word in ["region", "location", "where"]):
-        regions = sorted(df_clusters['Customer_Region'].unique())
-        region_info = "**Customer Regions:**\n"
-        for region in regions:
-            count = len(df_clusters[df_clusters['Customer_Region'] == region])
-            region_info += f"• **{region}** ({count} customers)\n"
-        return region_info
+@timed('help')
+def help_response(snap=None):
+    """List what the assistant can answer"""
+    snap = snap or dataset
+    available_clusters = sorted(snap.profiles)
+    available_products = snap.index.values('Product_Category')
+    
+    return ("🤖 **I can help you with:**\n"
+            "**Cluster Analysis:**\n"
+            f"• Available clusters: {', '.join(map(str, available_clusters))}\n"
+            "• Ask: *'Tell me about Cluster X'*\n"
+            "**Product Analysis:**\n"
+            f"• Categories: {', '.join(available_products)}\n"
+            "• Ask: *'Which cluster buys electronics?'*\n"
+            "**Slice Questions:**\n"
+            "• Ask: *'Average order value of mobile users in Asia in cluster 2'*\n"
+            "**Follow-up Questions:**\n"
+            "• Income, spending, age, devices, regions, etc.")
 
-    # Try product-based analysis
-    product_response = product_cluster_response(user_input)
-    if product_response:
-        return product_response
+@timed('cluster_lookup')
+def cluster_lookup_response(match, snap=None, state=None):
+    """Describe the cluster number mentioned in a message, or list the clusters"""
+    snap = snap or dataset
+    if match.number is not None:
+        cluster_id = match.number
+        if cluster_id in snap.profiles:
+            return get_cluster_info(cluster_id, snap, state)
+        available_clusters_str = ', '.join(map(str, sorted(snap.profiles)))
+        return f"Cluster {cluster_id} doesn't exist. Available clusters: {available_clusters_str}"
+    
+    cluster_info = "**Available Customer Clusters:**\n"
+    for cluster_id in sorted(snap.profiles):
+        cluster_size = snap.profiles[cluster_id]['size']
+        cluster_info += f"• **Cluster {cluster_id}** ({cluster_size} customers)\n"
+    cluster_info += "💡 *Ask about any specific cluster for detailed analysis*"
+    return cluster_info
+
+@timed('list_product_categories')
+def list_product_categories(snap=None):
+    """List product categories with customer counts"""
+    snap = snap or dataset
+    categories = snap.index.values('Product_Category')
+    category_info = "**Available Product Categories:**\n"
+    for category in categories:
+        count = snap.index.count(Product_Category=category)
+        category_info += f"• **{category}** ({count} customers)\n"
+    return category_info
+
+@timed('list_payment_methods')
+def list_payment_methods(snap=None):
+    """List payment methods with customer counts"""
+    snap = snap or dataset
+    payments = snap.index.values('Preferred_Payment_Method')
+    payment_info = "**Customer Payment Methods:**\n"
+    for payment in payments:
+        count = snap.index.count(Preferred_Payment_Method=payment)
+        payment_info += f"• **{payment}** ({count} customers)\n"
+    return payment_info
 
-    # Try follow-up questions about last cluster
-    follow_up = follow_up_on_last_cluster(user_input)
-    if follow_up:
-        return follow_up
+@timed('list_devices')
+def list_devices(snap=None):
+    """List devices with customer counts"""
+    snap = snap or dataset
+    devices = snap.index.values('Device_Used')
+    device_info = "📱 **Customer Device Usage:**\n"
+    for device in devices:
+        count = snap.index.count(Device_Used=device)
+        device_info += f"• **{device}** ({count} customers)\n"
+    return device_info
 
-    # Default response with suggestions
+@timed('list_regions')
+def list_regions(snap=None):
+    """List regions with customer counts"""
+    snap = snap or dataset
+    regions = snap.index.values('Customer_Region')
+    region_info = "**Customer Regions:**\n"
+    for region in regions:
+        count = snap.index.count(Customer_Region=region)
+        region_info += f"• **{region}** ({count} customers)\n"
+    return region_info
+
+def default_response():
+    """Fallback with suggestions"""
     return ("🤖 I didn't understand that query. Here are some things you can try:\n"
             "• *'Tell me about Cluster 0'*\n"
             "• *'Which cluster buys electronics?'*\n"
             "• *'Show available clusters'*\n"
             "• Type *'help'* for more options")
 
+# Slice Queries
+# Compound questions such as "average order value of mobile users in Asia in cluster 2" are parsed
+# into a statistic, a measure, filters and an optional breakdown, then answered from the cube.
+SLICE_MEASURES = {
+    # measure column: (label, phrases, format of the average)
+    'Average_Order_Value': ("Order Value", ["order value", "order values", "aov", "basket size"], "${:,.2f}"),
+    'Annual_Income': ("Income", ["income", "incomes", "salary", "salaries", "earnings"], "${:,.2f}"),
+    'Spending_Score': ("Spending Score", ["spending score", "spending", "spend"], "{:.1f}/100"),
+    'Number_of_Orders': ("Orders", ["number of orders", "orders", "order count"], "{:.1f}"),
+    'Review_Score': ("Review Score", ["review score", "review", "reviews", "rating", "ratings"], "{:.2f}/5.0"),
+    'Age': ("Age", ["age"], "{:.1f} years"),
+}
+SLICE_STATISTICS = {
+    'mean': ["average", "avg", "mean", "typical"],
+    'sum': ["total", "sum", "combined"],
+    'count': ["how many", "number of customers", "count"],
+}
+SLICE_DIMENSION_WORDS = {
+    'Cluster': ["cluster"],
+    'Gender': ["gender", "sex"],
+    'Customer_Region': ["region", "location", "continent"],
+    'Device_Used': ["device"],
+    'Preferred_Payment_Method': ["payment method", "payment"],
+    'Product_Category': ["product category", "product", "category"],
+    'Age_Group': ["age group", "age band"],
+    'Engagement_Level': ["engagement level", "engagement"],
+}
+SLICE_DIMENSION_LABELS = {
+    'Cluster': "Cluster", 'Gender': "Gender", 'Customer_Region': "Region", 'Device_Used': "Device",
+    'Preferred_Payment_Method': "Payment Method", 'Product_Category': "Product Category",
+    'Age_Group': "Age Group", 'Engagement_Level': "Engagement",
+}
+
+def phrase_pattern(phrases):
+    """Alternation matching whole phrases, longest first so 'highly active' wins over 'active'"""
+    ordered = sorted(set(phrases), key=len, reverse=True)
+    return r'(?<!\w)(?:' + '|'.join(re.escape(phrase) for phrase in ordered) + r')(?!\w)'
+
+SLICE_MEASURE_PATTERN = re.compile('|'.join(
+    f'(?P<{column}>{phrase_pattern(phrases)})' for column, (_, phrases, _) in SLICE_MEASURES.items()))
+SLICE_STATISTIC_PATTERN = re.compile('|'.join(
+    f'(?P<{name}>{phrase_pattern(phrases)})' for name, phrases in SLICE_STATISTICS.items()))
+SLICE_BY_PATTERN = re.compile(r'(?<!\w)(?:by|per|across|for each|broken down by)\s+(?:each\s+)?(?P<dimension>'
+                              + '|'.join(re.escape(word) for words in SLICE_DIMENSION_WORDS.values()
+                                         for word in sorted(words, key=len, reverse=True)) + r')s?(?!\w)')
+# Words allowed between a count and what it counts ("how many of the orders")
+SLICE_COUNT_GAP = re.compile(r'\s*(?:of\s+)?(?:the\s+)?(?:total\s+)?')
+# Measures that are themselves counts, so "how many orders" asks for their total
+SLICE_COUNTABLE_MEASURES = ('Number_of_Orders',)
+SLICE_CLUSTERS = re.compile(r'(?<!\w)clusters?\s+(\d+(?:\s*(?:,|and|or)\s*\d+)*)')
+
+class SliceQuery:
+    """A statistic of one measure (or a count) over a filtered slice, optionally broken down"""
+
+    def __init__(self, statistic, measure, filters, by):
+        self.statistic = statistic  # 'mean', 'sum' or 'count'
+        self.measure = measure      # measure column, None for counts
+        self.filters = filters      # column -> list of accepted values
+        self.by = by                # dimension to break the answer down by, or None
+
+def parse_slice_query(text, entities):
+    """Parse a compound question, or return None if it isn't a statistic over a slice"""
+    found = SLICE_STATISTIC_PATTERN.search(text)
+    if not found:
+        return None
+    statistic = found.lastgroup
+    counted = None
+    if statistic == 'count':
+        # A count of something other than customers is the total of that measure, if it has one
+        counted = SLICE_MEASURE_PATTERN.match(text, SLICE_COUNT_GAP.match(text, found.end()).end())
+        if counted and counted.lastgroup not in SLICE_COUNTABLE_MEASURES:
+            return None
+
+    by = SLICE_BY_PATTERN.search(text)
+    if by:
+        # Cut the breakdown out so "by age group" isn't also read as the age measure or a filter
+        text = text[:by.start()] + ' ' + text[by.end():]
+        word = by.group('dimension')
+        by = next(column for column, words in SLICE_DIMENSION_WORDS.items() if word in words)
+
+    measure = None
+    if counted:
+        statistic, measure = 'sum', counted.lastgroup
+    elif statistic != 'count':
+        found = SLICE_MEASURE_PATTERN.search(text)
+        if not found:
+            return None
+        measure = found.lastgroup
+
+    filters = {}
+    # A corrected typo is a guess, and a wrong filter would answer a different question without saying so
+    for mention in entities.extract(text):
+        if mention.distance:
+            continue
+        if mention.value not in filters.setdefault(mention.column, []):
+            filters[mention.column].append(mention.value)
+    # Lists such as "clusters 0 and 3" name several ids after one keyword
+    clusters = [int(number) for found in SLICE_CLUSTERS.finditer(text)
+                for number in re.findall(r'\d+', found.group(1))]
+    if clusters:
+        filters['Cluster'] = list(dict.fromkeys(filters.get('Cluster', []) + clusters))
+    if not filters and by is None:
+        return None
+    return SliceQuery(statistic, measure, filters, by)
+
+def slice_value_label(column, value):
+    if column == 'Cluster':
+        return f"Cluster {value}"
+    if column == 'Gender':
+        return "Male" if value == MALE else "Female" if value == FEMALE else str(value)
+    return str(value)
+
+@timed('slice_query')
+def slice_query_response(user_input, snap=None):
+    """Answer a count, average or total over any slice of the customers from the aggregate cube"""
+    snap = snap or dataset
+    cube = snap.cube
+    query = parse_slice_query(user_input.lower().strip(), snap.entities)
+    if query is None:
+        return None
+    # Unknown cluster numbers are reported by the cluster intents
+    if any(cluster_id not in snap.profiles for cluster_id in query.filters.get('Cluster', [])):
+        return None
+
+    filters = {column: query.filters[column] for column in cube.columns if column in query.filters}
+    scope = ' · '.join(' or '.join(slice_value_label(column, value) for value in values)
+                       for column, values in filters.items()) or "All customers"
+    if query.statistic == 'count':
+        title, icon = "Customers", "👥"
+    else:
+        label, _, value_format = SLICE_MEASURES[query.measure]
+        if query.statistic == 'sum':
+            title = f"Total {label}"
+            value_format = "${:,.2f}" if value_format.startswith('$') else "{:,.0f}"
+        else:
+            title = f"Average {label}"
+        icon = "📊"
+        measure = cube.measures.index(query.measure)
+
+    def statistic(count, sums):
+        if query.statistic == 'count':
+            return f"{int(count)} customers"
+        total = sums[measure] if query.statistic == 'sum' else sums[measure] / count
+        return value_format.format(total)
+
+    total_customers = snap.rows
+    if query.by is None:
+        count, sums = cube.rollup(filters)
+        if not count:
+            return f"No customers match {scope}."
+        share = f"{count / total_customers * 100:.1f}% of all customers"
+        if query.statistic == 'count':
+            return f"{icon} **{title}** · {scope}\n• **{count}** customers ({share})"
+        return f"{icon} **{title}** · {scope}\n• **{statistic(count, sums)}** across {count} customers ({share})"
+
+    counts, sums = cube.rollup(filters, by=query.by)
+    matched = int(counts.sum())
+    if not matched:
+        return f"No customers match {scope}."
+    response = f"{icon} **{title} by {SLICE_DIMENSION_LABELS[query.by]}** · {scope} ({matched} customers)\n"
+    by_values = cube.values(query.by)
+    if query.by in filters:
+        # rollup keeps only the filtered values on the breakdown axis, in filter order
+        by_values = [value for value in filters[query.by] if value in cube.positions[query.by]]
+    for position, value in enumerate(by_values):
+        count = counts[position]
+        if not count:
+            continue
+        label = slice_value_label(query.by, value)
+        if query.statistic == 'count':
+            response += f"• **{label}:** {int(count)} customers ({count / matched * 100:.1f}%)\n"
+        else:
+            response += f"• **{label}:** {statistic(count, sums[position])} ({int(count)} customers)\n"
+    return response
+
+# Intent Routing
+GREETING_WORDS = ["hello", "hi", "hey"]
+FEMALE_WORDS = ["female", "women", "woman"]
+MALE_WORDS = ["male", "men", "man"]
+HELP_WORDS = ["help", "what can you do", "commands", "options"]
+CLUSTER_LIST_WORDS = ["available", "show", "list", "what clusters"]
+PRODUCT_WORDS = ["product", "category", "categories", "available product", "what product"]
+PRODUCT_LIST_WORDS = ["available", "show", "list", "what are"]
+PAYMENT_WORDS = ["payment", "pay"]
+DEVICE_WORDS = ["device", "mobile", "desktop", "tablet"]
+REGION_WORDS = ["region", "location", "where"]
+
+# Follow-up topics about the last discussed cluster, checked in this order
+FOLLOW_UP_WORDS = {
+    'income': ["income", "salary", "earn", "money"],
+    'spending': ["spend", "spending", "score"],
+    'orders': ["order", "orders", "purchase"],
+    'reviews': ["review", "rating", "satisfaction"],
+    'devices': ["device", "mobile", "desktop", "tablet"],
+    'regions': ["region", "location", "where"],
+    'gender': ["gender", "male", "female"],
+    'age': ["age", "old", "young"],
+}
+
+CLUSTER_NUMBER = re.compile(r'cluster\s+(\d+)')
+
+def keyword_trie_pattern(words):
+    """Regex for the longest of `words` at a position, shaped as a trie so the cost per position
+    depends on keyword length rather than on how many keywords there are"""
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = {}
+
+    def build(node):
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ''
+        body = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+        return f'(?:{body})?' if '' in node else body
+
+    return build(trie)
+
+class MessageMatch:
+    """Everything the router found in one pass over a message"""
+
+    def __init__(self, text):
+        self.text = text
+        self.hits = set()      # keywords appearing anywhere in the message
+        self.leading = set()   # keywords the message starts with
+        self.number = None     # first standalone number
+        self.cluster_number = None  # first number written as "cluster N"
+
+    def has(self, words):
+        return any(word in self.hits for word in words)
+
+class IntentRouter:
+    """Single-pass keyword matcher that dispatches a message to the first intent that answers it"""
+
+    def __init__(self, intents):
+        # intents: (name, keywords, applies(match, snap), handler(user_input, match, snap, state)) in priority order
+        self.intents = intents
+        keywords = {word for _, words, _, _ in intents for word in words}
+        ordered = sorted(keywords, key=len, reverse=True)
+        # A keyword matching at a position implies every keyword that is a prefix of it matches too
+        self.implied = {word: [other for other in ordered if word.startswith(other)] for word in ordered}
+        self.pattern = re.compile(
+            r'(?=(?P<keyword>' + keyword_trie_pattern(keywords) + r')|(?P<number>(?<!\w)\d+(?!\w)))'
+        )
+
+    def scan(self, user_input):
+        """Collect keyword hits and numbers from a message"""
+        text = user_input.lower().strip()
+        match = MessageMatch(text)
+        for found in self.pattern.finditer(text):
+            keyword = found.group('keyword')
+            if keyword:
+                implied = self.implied[keyword]
+                match.hits.update(implied)
+                if found.start() == 0:
+                    match.leading.update(implied)
+                if match.cluster_number is None and 'cluster' in implied:
+                    numbered = CLUSTER_NUMBER.match(text, found.start())
+                    if numbered:
+                        match.cluster_number = int(numbered.group(1))
+            elif match.number is None:
+                match.number = int(found.group('number'))
+        return match
+
+    def route(self, user_input, snap=None, state=None, match=None):
+        """Return (intent name, response) for a message"""
+        snap = snap or dataset
+        state = session if state is None else state
+        if match is None:
+            with metrics.timer('chatbot_intent_match_seconds'):
+                match = self.scan(user_input)
+        for name, _, applies, handler in self.intents:
+            if applies(match, snap):
+                response = handler(user_input, match, snap, state)
+                if response:
+                    if snap.mode == 'approximate' and name not in EXACT_INTENTS:
+                        response = response.rstrip('\n') + '\n' + APPROXIMATE_NOTE
+                    return name, response
+        return 'unknown', default_response()
+
+intent_router = IntentRouter([
+    # Compound statistics ("average income of mobile users in Asia") need a statistic word and a
+    # slice; anything else falls through to the fixed intents below
+    ('slice', [word for words in SLICE_STATISTICS.values() for word in words],
+     lambda m, snap: m.has([word for words in SLICE_STATISTICS.values() for word in words]),
+     lambda text, m, snap, state: slice_query_response(text, snap)),
+    ('greeting', GREETING_WORDS + [f" {word}" for word in GREETING_WORDS],
+     lambda m, snap: m.leading & set(GREETING_WORDS) or m.has([f" {word}" for word in GREETING_WORDS]),
+     lambda text, m, snap, state: greeting_response()),
+    # A "cluster N" that doesn't exist is reported here too, before any other intent sees it
+    ('gender_products', FEMALE_WORDS + MALE_WORDS + ['cluster'],
+     lambda m, snap: m.has(FEMALE_WORDS) or m.has(MALE_WORDS)
+     or (m.cluster_number is not None and m.cluster_number not in snap.profiles),
+     lambda text, m, snap, state: gender_product_analysis(text, snap, m)),
+    ('help', HELP_WORDS,
+     lambda m, snap: m.has(HELP_WORDS),
+     lambda text, m, snap, state: help_response(snap)),
+    ('cluster', ['cluster'] + CLUSTER_LIST_WORDS,
+     lambda m, snap: 'cluster' in m.hits and (m.number is not None or m.has(CLUSTER_LIST_WORDS)),
+     lambda text, m, snap, state: cluster_lookup_response(m, snap, state)),
+    ('product_list', PRODUCT_WORDS + PRODUCT_LIST_WORDS,
+     lambda m, snap: m.has(PRODUCT_WORDS) and m.has(PRODUCT_LIST_WORDS),
+     lambda text, m, snap, state: list_product_categories(snap)),
+    ('payment_list', PAYMENT_WORDS,
+     lambda m, snap: m.has(PAYMENT_WORDS),
+     lambda text, m, snap, state: list_payment_methods(snap)),
+    ('device_list', DEVICE_WORDS,
+     lambda m, snap: m.has(DEVICE_WORDS),
+     lambda text, m, snap, state: list_devices(snap)),
+    ('region_list', REGION_WORDS,
+     lambda m, snap: m.has(REGION_WORDS),
+     lambda text, m, snap, state: list_regions(snap)),
+    ('product_cluster', [],
+     lambda m, snap: True,
+     lambda text, m, snap, state: product_cluster_response(text, snap, state, m)),
+    ('follow_up', [word for words in FOLLOW_UP_WORDS.values() for word in words],
+     lambda m, snap: True,
+     lambda text, m, snap, state: follow_up_on_last_cluster(text, snap, m, state)),
+])
+
+# Intents whose answers don't depend on sampled data
+EXACT_INTENTS = ('greeting', 'help')
+
+# Session keys the handlers read or write; everything else in the session is chat bookkeeping
+CONVERSATION_STATE_KEYS = ('last_cluster', 'last_product')
+
+class StateChanges(dict):
+    """Copy of the conversation state that records every key a handler sets"""
+
+    def __init__(self, data):
+        super().__init__(data)
+        self.changes = {}
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.changes[key] = value
+
+EXACT_RETRY_AFTER = 30  # seconds suggested to clients while exact figures are being built
+
+def answer_snapshot(exact=False):
+    """The live snapshot, or its exact counterpart when an approximate one is live and exact is asked for.
+    Raises ExactNotReady while that counterpart is still being built."""
+    snap = dataset
+    if exact and snap.mode == 'approximate':
+        return snap.exact()
+    return snap
+
+def exact_not_ready_response(error):
+    response = jsonify({'error': str(error)})
+    response.headers['Retry-After'] = str(EXACT_RETRY_AFTER)
+    return response, 503
+
+def route_message(user_input, exact=False):
+    """Classify a message and answer it, returning (intent, response)"""
+    started = time.perf_counter()
+    # Pin one snapshot for the whole message so a concurrent reload can't mix data versions
+    snap = answer_snapshot(exact)
+    # Answers depend only on the data, the message text and the last discussed cluster
+    key = (snap.digest, snap.mode, user_input.lower().strip(), session.get('last_cluster'))
+    cached = response_cache.get(key)
+    if cached is None:
+        state = StateChanges({k: session[k] for k in CONVERSATION_STATE_KEYS if k in session})
+        intent, response = intent_router.route(user_input, snap, state)
+        cached = (intent, response, state.changes)
+        response_cache.put(key, cached)
+    intent, response, changes = cached
+    if changes:
+        session.update(changes)
+    elapsed = time.perf_counter() - started
+    metrics.observe('chatbot_request_seconds', elapsed, intent=intent)
+    if SLOW_QUERY_MS and elapsed * 1000 >= SLOW_QUERY_MS:
+        log_slow_query(user_input, intent, elapsed)
+    return intent, response
+
+def cluster_aware_response(user_input):
+    """Main function to handle user queries and return appropriate responses"""
+    return route_message(user_input)[1]
+
+# Batch Queries
+MAX_BATCH_SIZE = int(os.environ.get('MAX_BATCH_SIZE', '1000'))
+
+class CrosstabCounts:
+    """Drop-in for RowIndex counting that answers from joint count arrays, one bincount per
+    combination of columns, so a whole group of queries shares a single pass over the rows"""
+
+    def __init__(self, index):
+        self.index = index
+        self.appearance = index.appearance
+        self.tables = {}  # sorted column tuple -> n-dimensional count array
+
+    def values(self, column):
+        return self.index.values(column)
+
+    def table(self, columns):
+        table = self.tables.get(columns)
+        if table is None:
+            shape = tuple(len(self.index.values(column)) for column in columns)
+            flat = np.ravel_multi_index([self.index.codes[column] for column in columns], shape)
+            table = np.bincount(flat, minlength=int(np.prod(shape))).reshape(shape)
+            self.tables[columns] = table
+        return table
+
+    def position(self, column, value):
+        try:
+            return self.index.values(column).index(value)
+        except ValueError:
+            return None
+
+    def value_counts(self, column, **filters):
+        columns = tuple(sorted(filters)) + (column,)
+        selector = tuple(self.position(name, filters[name]) for name in columns[:-1])
+        if None in selector:
+            return []
+        return ranked_counts(self.table(columns)[selector], self.index.values(column))
+
+    def count(self, **filters):
+        columns = tuple(sorted(filters))
+        selector = tuple(self.position(name, filters[name]) for name in columns)
+        if None in selector:
+            return 0
+        return int(self.table(columns)[selector])
+
+class BatchView:
+    """A snapshot whose counting is served by shared crosstabs for the duration of one batch"""
+
+    def __init__(self, snap):
+        self.df = snap.df
+        self.profiles = snap.profiles
+        self.digest = snap.digest
+        self.mode = snap.mode
+        self.rows = snap.rows
+        self.cube = snap.cube
+        self.entities = snap.entities
+        # Aggregate snapshots already answer counts from a joint table
+        self.index = CrosstabCounts(snap.index) if isinstance(snap.index, RowIndex) else snap.index
+
+def batch_context(item):
+    """Split a batch entry into its message and conversation state"""
+    if isinstance(item, str):
+        return item, {}
+    if not isinstance(item, dict):
+        raise TypeError("batch entries must be strings or objects")
+    state = {}
+    if item.get('last_cluster') is not None:
+        state['last_cluster'] = int(item['last_cluster'])
+    if item.get('last_product') is not None:
+        state['last_product'] = str(item['last_product'])
+    return str(item.get('message') or ''), state
+
+def answer_batch(items, snap=None):
+    """Answer many messages at once; results are in input order and match cluster_aware_response.
+
+    Every message in the batch counts through the same crosstabs, so a count query is a lookup once
+    any earlier message has built the table it needs.
+    """
+    view = BatchView(snap or dataset)
+    results = [None] * len(items)
+    for position, item in enumerate(items):
+        try:
+            message, state = batch_context(item)
+        except (TypeError, ValueError):
+            results[position] = {'error': 'Invalid batch entry'}
+            continue
+        message = message.strip()
+        if not message:
+            results[position] = {'error': 'Empty message'}
+            continue
+        changes = StateChanges(state)
+        intent, response = intent_router.route(message, view, changes)
+        results[position] = {'bot_response': response, 'intent': intent, 'context': dict(changes)}
+    return results
+
+# Cluster Assignment
+# New customers are placed in the nearest cluster in a standardised feature space: numeric columns
+# and one-hot categorical columns, each centred and scaled by its spread over the whole dataset.
+ASSIGN_NUMERIC_FEATURES = ['Age', 'Gender', 'Marital_Status', 'Annual_Income', 'Spending_Score',
+                           'Average_Order_Value', 'Number_of_Orders', 'Review_Score', 'High_Spender']
+ASSIGN_CATEGORICAL_FEATURES = ['Customer_Region', 'Product_Category', 'Preferred_Payment_Method',
+                               'Preferred_Delivery_Option', 'Device_Used', 'Age_Group', 'Engagement_Level']
+ASSIGN_FEATURES = ASSIGN_NUMERIC_FEATURES + ASSIGN_CATEGORICAL_FEATURES
+ASSIGN_CHUNK_ROWS = int(os.environ.get('ASSIGN_CHUNK_ROWS', '4096'))  # records scored per distance product
+MAX_ASSIGN_RECORDS = int(os.environ.get('MAX_ASSIGN_RECORDS', '50000'))
+
+def encode_features(frame, categories):
+    """Raw feature matrix: numeric columns, then one indicator per categorical value in
+    `categories`. Values outside `categories` get no indicator."""
+    blocks = [frame[ASSIGN_NUMERIC_FEATURES].to_numpy(dtype='float64')]
+    for column in ASSIGN_CATEGORICAL_FEATURES:
+        values = categories[column]
+        codes = pd.Categorical(frame[column], categories=values).codes
+        blocks.append((codes[:, None] == np.arange(len(values))).astype('float64'))
+    return np.hstack(blocks)
+
+class ClusterCentroids:
+    """Feature scaling and per-cluster centroids, scoring records in fixed-size chunks"""
+
+    def __init__(self, categories, clusters, center, scale, centroids):
+        self.categories = categories  # categorical column -> values, in one-hot order
+        self.clusters = np.asarray(clusters)
+        self.center = center
+        self.scale = scale
+        self.centroids = centroids  # one standardised row per cluster
+        self.norms = (centroids ** 2).sum(axis=1)
+
+    @classmethod
+    def build(cls, df, weights=None, chunk_rows=ASSIGN_CHUNK_ROWS):
+        """Centroids from a frame holding the feature columns and Cluster; rows may be weighted"""
+        categories = {column: sorted(np.asarray(pd.unique(df[column])).tolist())
+                      for column in ASSIGN_CATEGORICAL_FEATURES}
+        clusters = sorted(np.asarray(pd.unique(df['Cluster'])).tolist())
+        weights = np.ones(len(df)) if weights is None else np.asarray(weights, dtype='float64')
+        positions = pd.Categorical(df['Cluster'], categories=clusters).codes
+
+        # Weighted first and second moments, overall and per cluster, one chunk at a time
+        width = len(ASSIGN_NUMERIC_FEATURES) + sum(len(values) for values in categories.values())
+        totals, squares = np.zeros(width), np.zeros(width)
+        cluster_totals, cluster_weights = np.zeros((len(clusters), width)), np.zeros(len(clusters))
+        for start in range(0, len(df), chunk_rows):
+            features = encode_features(df.iloc[start:start + chunk_rows], categories)
+            chunk_weights = weights[start:start + chunk_rows]
+            members = np.eye(len(clusters))[positions[start:start + chunk_rows]] * chunk_weights[:, None]
+            totals += chunk_weights @ features
+            squares += chunk_weights @ (features ** 2)
+            cluster_totals += members.T @ features
+            cluster_weights += members.sum(axis=0)
+        center = totals / weights.sum()
+        scale = np.sqrt(np.maximum(squares / weights.sum() - center ** 2, 0.0))
+        scale[scale == 0] = 1.0  # constant features don't separate clusters
+        centroids = (cluster_totals / cluster_weights[:, None] - center) / scale
+        return cls(categories, clusters, center, scale, centroids)
+
+    def assign(self, frame, chunk_rows=ASSIGN_CHUNK_ROWS):
+        """Nearest cluster id and Euclidean distance to it for every record"""
+        labels = np.empty(len(frame), dtype=self.clusters.dtype)
+        distances = np.empty(len(frame))
+        for start in range(0, len(frame), chunk_rows):
+            features = (encode_features(frame.iloc[start:start + chunk_rows], self.categories) - self.center) / self.scale
+            # Squared distances to every centroid in one product: |x|^2 - 2 x.c + |c|^2
+            squared = (features ** 2).sum(axis=1)[:, None] - 2 * features @ self.centroids.T + self.norms
+            nearest = squared.argmin(axis=1)
+            end = start + len(features)
+            labels[start:end] = self.clusters[nearest]
+            distances[start:end] = np.sqrt(np.maximum(squared[np.arange(len(nearest)), nearest], 0.0))
+        return labels, distances
+
+def records_frame(records):
+    """Frame of customer records, rejecting ones without every feature or with non-numeric numbers"""
+    frame = records if isinstance(records, pd.DataFrame) else pd.DataFrame.from_records(records)
+    missing = [column for column in ASSIGN_FEATURES if column not in frame.columns]
+    if missing:
+        raise ValueError(f"Records are missing feature columns: {', '.join(missing)}")
+    numeric = frame[ASSIGN_NUMERIC_FEATURES].apply(pd.to_numeric, errors='coerce')
+    bad = [column for column in ASSIGN_NUMERIC_FEATURES if numeric[column].isna().any()]
+    if bad:
+        raise ValueError(f"Records need numbers in: {', '.join(bad)}")
+    frame = frame[ASSIGN_FEATURES].copy()
+    frame[ASSIGN_NUMERIC_FEATURES] = numeric
+    return frame
+
+@timed('assign_clusters')
+def assign_clusters(records, snap=None):
+    """Assign customer records (dicts or a frame with the CSV's feature columns) to their nearest
+    clusters, returning arrays of cluster ids and distances in standardised units"""
+    snap = snap or dataset
+    if snap.centroids is None:
+        raise RuntimeError("Cluster assignment needs row-level data, which aggregate mode doesn't keep")
+    return snap.centroids.assign(records_frame(records))
+
+# Server-side Sessions
+# The cookie only carries a random session id; conversation state lives in a pluggable store.
+# Worker processes the server runs, as read by uvicorn and gunicorn. In-memory sessions live in one
+# process, so with several workers a request landing elsewhere would start a new conversation.
+WORKER_COUNT = int(os.environ.get('WEB_CONCURRENCY', '1'))
+SESSION_BACKEND = os.environ.get('CHAT_SESSION_BACKEND', 'sqlite' if WORKER_COUNT > 1 else 'memory')  # 'memory' or 'sqlite'
+SESSION_DB_PATH = os.environ.get('CHAT_SESSION_DB', 'chat_sessions.sqlite3')
+SESSION_TTL = int(os.environ.get('CHAT_SESSION_TTL', str(24 * 3600)))  # seconds of inactivity
+MAX_SESSIONS = int(os.environ.get('CHAT_MAX_SESSIONS', '10000'))  # memory backend only
+MAX_MESSAGES = int(os.environ.get('CHAT_MAX_MESSAGES', '100'))
+MAX_HISTORY = int(os.environ.get('CHAT_MAX_HISTORY', '20'))
+
+def conversation_buffer(session, key, limit):
+    """Ring buffer of the last `limit` entries stored under `key` in the session"""
+    buffer = session.get(key)
+    if not isinstance(buffer, deque) or buffer.maxlen != limit:
+        buffer = deque(buffer or [], maxlen=limit)
+        session[key] = buffer
+    return buffer
+
+class ServerSession(CallbackDict, SessionMixin):
+    """Session dict identified by an opaque id instead of being serialised into the cookie"""
+
+    def __init__(self, data=None, sid=None, new=False):
+        def on_update(self):
+            self.modified = True
+        super().__init__(data, on_update)
+        self.sid = sid or secrets.token_urlsafe(32)
+        self.new = new
+        self.modified = False
+
+class MemorySessionStore:
+    """Per-process session store with expiry and a least-recently-used bound on session count"""
+
+    def __init__(self, max_sessions=MAX_SESSIONS):
+        self.max_sessions = max_sessions
+        self.sessions = OrderedDict()  # sid -> (expires_at, data)
+        self.lock = threading.Lock()
+
+    def load(self, sid):
+        with self.lock:
+            entry = self.sessions.get(sid)
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                del self.sessions[sid]
+                return None
+            self.sessions.move_to_end(sid)
+            return entry[1]
+
+    def save(self, sid, data, ttl):
+        with self.lock:
+            self.sessions[sid] = (time.time() + ttl, data)
+            self.sessions.move_to_end(sid)
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+
+    def delete(self, sid):
+        with self.lock:
+            self.sessions.pop(sid, None)
+
+class SQLiteSessionStore:
+    """Session store in a local SQLite file, shared by all workers on the host"""
+
+    PURGE_INTERVAL = 60
+
+    def __init__(self, path=SESSION_DB_PATH):
+        self.path = path
+        self.last_purge = 0.0
+        with self.connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS chat_sessions "
+                         "(sid TEXT PRIMARY KEY, expires_at REAL NOT NULL, data TEXT NOT NULL)")
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=5)
+
+    def load(self, sid):
+        with self.connect() as conn:
+            row = conn.execute("SELECT data FROM chat_sessions WHERE sid = ? AND expires_at >= ?",
+                               (sid, time.time())).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save(self, sid, data, ttl):
+        now = time.time()
+        with self.connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO chat_sessions (sid, expires_at, data) VALUES (?, ?, ?)",
+                         (sid, now + ttl, json.dumps(data, default=list)))
+            if now - self.last_purge > self.PURGE_INTERVAL:
+                self.last_purge = now
+                conn.execute("DELETE FROM chat_sessions WHERE expires_at < ?", (now,))
+
+    def delete(self, sid):
+        with self.connect() as conn:
+            conn.execute("DELETE FROM chat_sessions WHERE sid = ?", (sid,))
+
+class ServerSideSessionInterface(SessionInterface):
+    """Flask session interface backed by a MemorySessionStore or SQLiteSessionStore"""
+
+    def __init__(self, store, ttl=SESSION_TTL):
+        self.store = store
+        self.ttl = ttl
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            with metrics.timer('chatbot_session_seconds', operation='load'):
+                data = self.store.load(sid)
+            if data is not None:
+                return ServerSession(data, sid)
+        return ServerSession(new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if not session:
+            if session.modified and not session.new:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+        if session.modified or session.new:
+            with metrics.timer('chatbot_session_seconds', operation='save'):
+                self.store.save(session.sid, dict(session), self.ttl)
+            response.set_cookie(
+                name, session.sid, max_age=self.ttl, domain=domain, path=path,
+                httponly=self.get_cookie_httponly(app), secure=self.get_cookie_secure(app),
+                samesite=self.get_cookie_samesite(app),
+            )
+
+def create_session_store():
+    """Build the session store selected by CHAT_SESSION_BACKEND"""
+    if SESSION_BACKEND == 'sqlite':
+        return SQLiteSessionStore(SESSION_DB_PATH)
+    if SESSION_BACKEND != 'memory':
+        print(f"WARNING: unknown session backend '{SESSION_BACKEND}', using in-memory sessions")
+    if WORKER_COUNT > 1:
+        print(f"WARNING: in-memory sessions aren't shared between the {WORKER_COUNT} workers; "
+              f"set CHAT_SESSION_BACKEND=sqlite")
+    return MemorySessionStore(MAX_SESSIONS)
+
+app.session_interface = ServerSideSessionInterface(create_session_store())
+
+# HTTP Caching and Compression
+COMPRESS_MIN_BYTES = int(os.environ.get('COMPRESS_MIN_BYTES', '1024'))
+COMPRESS_LEVEL = int(os.environ.get('COMPRESS_LEVEL', '6'))
+PAGE_CACHE_SECONDS = int(os.environ.get('PAGE_CACHE_SECONDS', '86400'))
+COMPRESSIBLE_TYPES = ('text/html', 'text/plain', 'text/css', 'application/json', 'application/javascript',
+                      'image/svg+xml')
+
+def preferred_encoding():
+    """Best content coding the client accepts: brotli when installed, then gzip, else None"""
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        return 'br'
+    if accepted['gzip']:
+        return 'gzip'
+    return None
+
+def compress_bytes(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data, quality=min(COMPRESS_LEVEL, 11))
+    return gzip.compress(data, compresslevel=COMPRESS_LEVEL)
+
+# template name -> (template mtime, {content coding or None: body}, etag)
+page_cache = {}
+
+def static_page(name):
+    """A template without per-request content, rendered and compressed once per template change"""
+    mtime = os.stat(os.path.join(app.root_path, app.template_folder, name)).st_mtime_ns
+    cached = page_cache.get(name)
+    if cached is None or cached[0] != mtime:
+        body = render_template(name).encode('utf8')
+        bodies = {None: body, 'gzip': compress_bytes(body, 'gzip')}
+        if brotli is not None:
+            bodies['br'] = compress_bytes(body, 'br')
+        cached = (mtime, bodies, hashlib.sha256(body).hexdigest()[:32])
+        page_cache[name] = cached
+    return cached[1], cached[2]
+
+@app.after_request
+def compress_response(response):
+    """Compress sizeable text responses for clients that accept it; streams are left alone so
+    server-sent events still arrive as they are written"""
+    if response.direct_passthrough or response.is_streamed or 'Content-Encoding' in response.headers \
+            or response.mimetype not in COMPRESSIBLE_TYPES \
+            or response.status_code < 200 or response.status_code in (204, 304):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = preferred_encoding()
+    data = response.get_data()
+    if encoding is None or len(data) < COMPRESS_MIN_BYTES:
+        return response
+    response.set_data(compress_bytes(data, encoding))
+    response.headers['Content-Encoding'] = encoding
+    # The compressed bytes differ from the ones a strong ETag names; a weak one still revalidates
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
 # Routes
 @app.route('/')
 def index():
     """Main page route"""
-    # Initialize session variables
-    if 'messages' not in session:
-        session['messages'] = []
-    if 'chat_history' not in session:
-        session['chat_history'] = []
-    if 'dark_theme' not in session:
-        session['dark_theme'] = False
+    # The page is a static shell whose scripts fetch everything per-user, so it touches no session
+    # state, sets no cookie and can be cached and revalidated like a static file
+    bodies, etag = static_page('index.html')
+    encoding = preferred_encoding()
+    response = Response(bodies[encoding], mimetype='text/html')
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    response.set_etag(etag, weak=True)
+    response.cache_control.public = True
+    response.cache_control.max_age = PAGE_CACHE_SECONDS
+    return response.make_conditional(request)
+
+def record_exchange(user_input, bot_response):
+    """Append a question and its answer to the session's message and history buffers"""
+    # Add to session messages (bounded ring buffer)
+    messages = conversation_buffer(session, 'messages', MAX_MESSAGES)
+    messages.append({'role': 'user', 'content': user_input})
+    messages.append({'role': 'assistant', 'content': bot_response})
+    
+    # Add to chat history with timestamp, keeping only the last MAX_HISTORY conversations.
+    # Ids keep increasing across clears so they work as pagination cursors.
+    timestamp = datetime.now().strftime("%H:%M")
+    history_id = session.get('history_seq', 0) + 1
+    session['history_seq'] = history_id
+    conversation_buffer(session, 'chat_history', MAX_HISTORY).append({
+        'id': history_id,
+        'timestamp': timestamp,
+        'user_message': user_input,
+        'bot_message': bot_response
+    })
     
-    return render_template('index.html')
+    session.modified = True
+    return timestamp
+
+def sse_event(data, event=None):
+    """Format one server-sent event"""
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data, ensure_ascii=False)}\n\n"
 
 @app.route('/send_message', methods=['POST'])
 def send_message():
     """Handle chat messages"""
     try:
         user_input = request.json.get('message', '').strip()
+        # In approximate mode, 'exact' asks for figures from the full data instead of the sample
+        exact = bool(request.json.get('exact'))
         
         if not user_input:
             return jsonify({'error': 'Empty message'}), 400
         
-        # Get bot response
-        bot_response = cluster_aware_response(user_input)
+        # Get bot response and the intent that produced it
+        intent, bot_response = route_message(user_input, exact)
+        timestamp = record_exchange(user_input, bot_response)
         
-        # Add to session messages
-        if 'messages' not in session:
-            session['messages'] = []
+        with metrics.timer('chatbot_response_serialize_seconds'):
+            return jsonify({
+                'bot_response': bot_response,
+                'intent': intent,
+                'timestamp': timestamp
+            })
+    
+    except ExactNotReady as e:
+        return exact_not_ready_response(e)
+    except Exception as e:
+        print(f"Error in send_message: {e}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+@app.route('/stream_message', methods=['GET', 'POST'])
+def stream_message():
+    """Answer a chat message as server-sent events, one line of the answer per 'data' event"""
+    try:
+        if request.method == 'POST':
+            user_input = (request.json or {}).get('message', '').strip()
+            exact = bool((request.json or {}).get('exact'))
+        else:
+            user_input = request.args.get('message', '').strip()
+            exact = request.args.get('exact', '').lower() in ('1', 'true', 'yes')
         
-        session['messages'].append({'role': 'user', 'content': user_input})
-        session['messages'].append({'role': 'assistant', 'content': bot_response})
+        if not user_input:
+            return jsonify({'error': 'Empty message'}), 400
         
-        # Add to chat history with timestamp
-        timestamp = datetime.now().strftime("%H:%M")
-        if 'chat_history' not in session:
-            session['chat_history'] = []
+        # The answer and session updates are settled before streaming starts, because the
+        # session is saved when the response headers go out
+        intent, bot_response = route_message(user_input, exact)
+        timestamp = record_exchange(user_input, bot_response)
+    
+    except ExactNotReady as e:
+        return exact_not_ready_response(e)
+    except Exception as e:
+        print(f"Error in stream_message: {e}")
+        return jsonify({'error': 'Internal server error'}), 500
+    
+    def events():
+        yield sse_event({'intent': intent, 'timestamp': timestamp}, event='meta')
+        for line in bot_response.split('\n'):
+            yield sse_event(line)
+        yield sse_event({}, event='done')
+    
+    return Response(events(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/send_messages', methods=['POST'])
+def send_messages():
+    """Answer a batch of messages, each with optional last_cluster/last_product context"""
+    try:
+        items = (request.json or {}).get('messages')
         
-        session['chat_history'].append({
-            'timestamp': timestamp,
-            'user_message': user_input,
-            'bot_message': bot_response
-        })
+        if not isinstance(items, list):
+            return jsonify({'error': "'messages' must be a list"}), 400
+        if len(items) > MAX_BATCH_SIZE:
+            return jsonify({'error': f'At most {MAX_BATCH_SIZE} messages per batch'}), 400
         
-        # Keep only last 20 conversations in history
-        if len(session['chat_history']) > 20:
-            session['chat_history'] = session['chat_history'][-20:]
+        exact = bool((request.json or {}).get('exact'))
+        return jsonify({'results': answer_batch(items, answer_snapshot(exact))})
+    
+    except ExactNotReady as e:
+        return exact_not_ready_response(e)
+    except Exception as e:
+        print(f"Error in send_messages: {e}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+@app.route('/assign_clusters', methods=['POST'])
+def assign_clusters_endpoint():
+    """Assign a batch of new customer records to clusters"""
+    try:
+        records = (request.json or {}).get('records')
         
-        session.modified = True
+        if not isinstance(records, list) or not all(isinstance(record, dict) for record in records):
+            return jsonify({'error': "'records' must be a list of objects"}), 400
+        if len(records) > MAX_ASSIGN_RECORDS:
+            return jsonify({'error': f'At most {MAX_ASSIGN_RECORDS} records per request'}), 400
+        if not records:
+            return jsonify({'clusters': [], 'distances': []})
         
-        return jsonify({
-            'bot_response': bot_response,
-            'timestamp': timestamp
-        })
+        try:
+            clusters, distances = assign_clusters(records)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        except RuntimeError as e:
+            return jsonify({'error': str(e)}), 503
+        
+        return jsonify({'clusters': clusters.tolist(), 'distances': np.round(distances, 4).tolist()})
     
     except Exception as e:
-        print(f"Error in send_message: {e}")
+        print(f"Error in assign_clusters: {e}")
         return jsonify({'error': 'Internal server error'}), 500
 
 @app.route('/toggle_theme', methods=['POST'])
@@ -452,8 +2605,61 @@ def clear_history():
 
 @app.route('/get_chat_history')
 def get_chat_history():
-    """Get chat history for display"""
-    return jsonify(session.get('chat_history', []))
+    """Get chat history for display, oldest first.
+
+    Optional cursors page through it: `after`/`before` keep entries with ids above/below the
+    given id and `limit` keeps the newest that many; a Link header points at the next older page
+    while one remains.
+    """
+    history = list(session.get('chat_history', []))
+    try:
+        after = request.args.get('after')
+        before = request.args.get('before')
+        limit = request.args.get('limit')
+        after = int(after) if after is not None else None
+        before = int(before) if before is not None else None
+        limit = int(limit) if limit is not None else None
+    except ValueError:
+        return jsonify({'error': "'after', 'before' and 'limit' must be integers"}), 400
+    if limit is not None and limit < 0:
+        return jsonify({'error': "'limit' must not be negative"}), 400
+    
+    if after is not None:
+        history = [entry for entry in history if entry.get('id', 0) > after]
+    if before is not None:
+        history = [entry for entry in history if entry.get('id', 0) < before]
+    older = None
+    if limit is not None and len(history) > limit:
+        history = history[len(history) - limit:]
+        older = history[0].get('id') if history else None
+    
+    response = jsonify(history)
+    if older is not None:
+        # Older entries remain inside the `after` bound, so the next page keeps that bound too
+        bound = f"after={after}&" if after is not None else ""
+        response.headers['Link'] = f'</get_chat_history?{bound}before={older}&limit={limit}>; rel="next"'
+    # Polls revalidate against the ETag and get an empty 304 while the history is unchanged
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    response.vary.add('Cookie')
+    response.add_etag()
+    return response.make_conditional(request)
+
+@app.route('/cache_stats')
+def cache_stats():
+    """Response cache counters"""
+    return jsonify(response_cache.stats())
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus metrics"""
+    lines = []
+    for name, metric_type, description, value in dataset_gauges():
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        lines.append(f"{name} {value}")
+    body = '\n'.join(lines) + '\n' + metrics.render()
+    return Response(body, mimetype='text/plain; version=0.0.4')
 
 @app.route('/load_conversation', methods=['POST'])
 def load_conversation():
@@ -466,11 +2672,9 @@ def load_conversation():
         if not user_msg or not bot_msg:
             return jsonify({'error': 'Invalid conversation data'}), 400
         
-        if 'messages' not in session:
-            session['messages'] = []
-        
-        session['messages'].append({'role': 'user', 'content': user_msg})
-        session['messages'].append({'role': 'assistant', 'content': bot_msg})
+        messages = conversation_buffer(session, 'messages', MAX_MESSAGES)
+        messages.append({'role': 'user', 'content': user_msg})
+        messages.append({'role': 'assistant', 'content': bot_msg})
         session.modified = True
         
         return jsonify({'status': 'success'})
@@ -0,0 +1,147 @@
+"""ASGI entry point for the chat app.
+
+Request bodies are read and responses written on the event loop. Flask views, which do the
+DataFrame work, run in a bounded thread pool, so slow clients and large history payloads don't
+hold a thread. Streaming responses such as /stream_message are forwarded chunk by chunk.
+
+    WEB_CONCURRENCY=4 uvicorn asgi:application
+
+Each worker is a separate process, so chat sessions must live in a store they share. Setting the
+worker count through WEB_CONCURRENCY makes the app default to CHAT_SESSION_BACKEND=sqlite. When
+passing --workers instead, set CHAT_SESSION_BACKEND=sqlite yourself, or follow-ups and history are
+lost whenever a request lands on another worker.
+"""
+import asyncio
+import io
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from app import app
+
+EXECUTOR_THREADS = int(os.environ.get('ASGI_EXECUTOR_THREADS', '8'))
+# Views allowed to wait for or hold an executor thread at once; the rest wait on the loop
+MAX_PENDING = int(os.environ.get('ASGI_MAX_PENDING', '64'))
+MAX_BODY_BYTES = int(os.environ.get('ASGI_MAX_BODY_BYTES', str(1 << 20)))
+
+def build_environ(scope, body):
+    """WSGI environ for an ASGI HTTP scope"""
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf8').decode('latin1'),
+        'PATH_INFO': scope['path'].encode('utf8').decode('latin1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'REMOTE_ADDR': client[0],
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin1').upper().replace('-', '_')
+        value = value.decode('latin1')
+        if name == 'CONTENT_LENGTH':
+            continue
+        key = name if name == 'CONTENT_TYPE' else f"HTTP_{name}"
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+class AsyncBridge:
+    """ASGI application that serves a WSGI app from a bounded thread pool"""
+
+    def __init__(self, wsgi_app, threads=EXECUTOR_THREADS, max_pending=MAX_PENDING):
+        self.wsgi_app = wsgi_app
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='chat-view')
+        self.max_pending = max_pending
+        self.slots = None
+
+    async def run(self, func, *args):
+        """Run blocking work in the executor, waiting on the loop when it is saturated"""
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.max_pending)
+        async with self.slots:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    def start(self, environ):
+        """Call the WSGI app and return its status, headers and body iterator"""
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started['status'] = int(status.split(' ', 1)[0])
+            started['headers'] = [(name.encode('latin1'), value.encode('latin1')) for name, value in headers]
+
+        body = self.wsgi_app(environ, start_response)
+        return started['status'], started['headers'], body
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+
+        body = bytearray()
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body.extend(message.get('body', b''))
+            if len(body) > MAX_BODY_BYTES:
+                await send_simple(send, 413, b'Request body too large')
+                return
+            if not message.get('more_body'):
+                break
+
+        status, headers, chunks = await self.run(self.start, build_environ(scope, bytes(body)))
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        try:
+            if isinstance(chunks, (list, tuple)):
+                await send({'type': 'http.response.body', 'body': b''.join(chunks)})
+                return
+            iterator = iter(chunks)
+            while True:
+                # Generators may do work per chunk, so each step runs in the executor too
+                chunk = await self.run(next, iterator, None)
+                if chunk is None:
+                    break
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            close = getattr(chunks, 'close', None)
+            if close:
+                await self.run(close)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+async def send_simple(send, status, body):
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'text/plain; charset=utf-8')]})
+    await send({'type': 'http.response.body', 'body': body})
+
+application = AsyncBridge(app.wsgi_app)
+
+if __name__ == '__main__':
+    try:
+        import uvicorn
+    except ImportError:
+        print("Serving the ASGI app needs an ASGI server, e.g. `pip install uvicorn`.")
+        sys.exit(1)
+    uvicorn.run(application, host='0.0.0.0', port=int(os.environ.get('PORT', '3000')))
@@ -0,0 +1,378 @@
+"""Load-testing and benchmark harness for the chat endpoint.
+
+Generate synthetic customer files with the same schema as the real export, then drive
+/send_message against each dataset size and write machine-readable results:
+
+    python benchmark.py generate --sizes 22000,1000000,10000000
+    python benchmark.py run --sizes 22000,1000000 --requests 2000 --output bench.json
+    python benchmark.py run --mode http --concurrency 8 --baseline bench.json
+
+Every dataset size runs in a fresh process so startup time and RSS are measured cleanly.
+"""
+import argparse
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+from contextlib import redirect_stdout
+from http.cookiejar import CookieJar
+
+import numpy as np
+import pandas as pd
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+SOURCE_CSV = os.path.join(APP_DIR, "ecommerce_customer_clusters_for_tableau.csv")
+DEFAULT_DATA_DIR = os.path.join(APP_DIR, "bench_data")
+DEFAULT_SIZES = "22000,100000,1000000"
+
+# Message templates per intent; {cluster} and {product} are filled from the dataset
+QUERY_TEMPLATES = {
+    'greeting': ["hello", "hi there"],
+    'help': ["help", "what can you do"],
+    'cluster': ["tell me about cluster {cluster}", "show available clusters"],
+    'gender_products': ["what do women buy", "male preferences in cluster {cluster}"],
+    'product_list': ["show product categories"],
+    # "payment" contains "men", which routes to gender_products
+    'payment_list': ["how do customers pay", "ways to pay"],
+    'device_list': ["which devices do customers use"],
+    'region_list': ["customer regions"],
+    'product_cluster': ["which cluster buys {product}"],
+    'follow_up': ["income", "spending", "orders", "reviews", "age"],
+    'unknown': ["what is the weather"],
+}
+
+# Roughly what production traffic looks like: mostly cluster lookups and follow-ups
+DEFAULT_MIX = "cluster=30,follow_up=25,product_cluster=15,gender_products=10,help=5,greeting=5,payment_list=2,device_list=2,region_list=2,product_list=2,unknown=2"
+
+def parse_sizes(text):
+    return [int(float(size)) for size in text.split(',') if size]
+
+def parse_mix(text):
+    """Parse 'intent=weight,...' into a weights dict"""
+    mix = {}
+    for part in text.split(','):
+        intent, _, weight = part.partition('=')
+        if intent not in QUERY_TEMPLATES:
+            raise ValueError(f"Unknown intent '{intent}' in query mix")
+        mix[intent] = float(weight or 1)
+    return mix
+
+def dataset_path(data_dir, rows):
+    return os.path.join(data_dir, f"customers_{rows}.csv")
+
+def generate_dataset(path, rows, seed=0, chunk_rows=1_000_000):
+    """Write a synthetic export by resampling each column within its cluster from the real file"""
+    source = pd.read_csv(SOURCE_CSV)
+    rng = np.random.default_rng(seed)
+    clusters = source.groupby('Cluster')
+    cluster_ids = np.array(list(clusters.groups))
+    weights = clusters.size().to_numpy() / len(source)
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = path + '.tmp'
+    written = 0
+    with open(tmp_path, 'w', newline='') as f:
+        while written < rows:
+            n = min(chunk_rows, rows - written)
+            per_cluster = rng.multinomial(n, weights)
+            parts = []
+            for cluster_id, count in zip(cluster_ids, per_cluster):
+                if not count:
+                    continue
+                group = clusters.get_group(cluster_id)
+                parts.append(pd.DataFrame({
+                    column: rng.choice(group[column].to_numpy(), count) for column in source.columns
+                }))
+            chunk = pd.concat(parts, ignore_index=True).sample(frac=1, random_state=int(rng.integers(1 << 31)))
+            chunk.to_csv(f, header=(written == 0), index=False)
+            written += n
+    os.replace(tmp_path, path)
+    return path
+
+def ensure_datasets(sizes, data_dir, seed=0):
+    paths = {}
+    for rows in sizes:
+        path = dataset_path(data_dir, rows)
+        if not os.path.exists(path):
+            started = time.perf_counter()
+            generate_dataset(path, rows, seed)
+            print(f"Generated {rows} rows in {time.perf_counter() - started:.1f}s -> {path}", file=sys.stderr)
+        paths[rows] = path
+    return paths
+
+def build_queries(count, mix, clusters, products, seed=0):
+    """Draw (intent, message) pairs according to the mix"""
+    rng = random.Random(seed)
+    intents = list(mix)
+    weights = [mix[intent] for intent in intents]
+    queries = []
+    for intent in rng.choices(intents, weights, k=count):
+        template = rng.choice(QUERY_TEMPLATES[intent])
+        queries.append((intent, template.format(cluster=rng.choice(clusters), product=rng.choice(products).lower())))
+    return queries
+
+def percentiles(samples):
+    """Latency summary in milliseconds"""
+    if not samples:
+        return {'count': 0}
+    values = np.asarray(samples) * 1000
+    return {
+        'count': len(values),
+        'mean_ms': float(values.mean()),
+        'p50_ms': float(np.percentile(values, 50)),
+        'p95_ms': float(np.percentile(values, 95)),
+        'p99_ms': float(np.percentile(values, 99)),
+        'max_ms': float(values.max()),
+    }
+
+def rss_mb(pid='self'):
+    """Resident set size from /proc, or the peak from getrusage where /proc is unavailable"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    if pid == 'self':
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return None
+
+def summarize(samples, elapsed):
+    """Overall and per-intent latency plus throughput"""
+    by_intent = {}
+    for intent, latency in samples:
+        by_intent.setdefault(intent, []).append(latency)
+    return {
+        'throughput_rps': len(samples) / elapsed if elapsed else 0.0,
+        'latency': percentiles([latency for _, latency in samples]),
+        'by_intent': {intent: percentiles(values) for intent, values in sorted(by_intent.items())},
+    }
+
+def worker_env(args, data_file):
+    env = dict(os.environ)
+    env['CLUSTER_DATA_FILE'] = data_file
+    env['CLUSTER_RELOAD_INTERVAL'] = '0'
+    if args.no_cache:
+        env['RESPONSE_CACHE_SIZE'] = '0'
+    return env
+
+def run_inprocess_worker(args):
+    """Child process: import the app against CLUSTER_DATA_FILE and drive it with the test client"""
+    sys.path.insert(0, APP_DIR)
+    os.chdir(APP_DIR)
+    started = time.perf_counter()
+    with redirect_stdout(sys.stderr):
+        import app
+    startup = time.perf_counter() - started
+    rss_after_load = rss_mb()
+
+    clients = [app.app.test_client() for _ in range(max(args.sessions, 1))]
+    clusters, products = _parse_help(clients[0].post('/send_message', json={'message': 'help'}).get_json()['bot_response'])
+    queries = build_queries(args.requests + args.warmup, parse_mix(args.mix), clusters, products, args.seed)
+    samples = []
+    started = time.perf_counter()
+    for i, (_, message) in enumerate(queries):
+        if i == args.warmup:
+            samples.clear()
+            started = time.perf_counter()
+        t0 = time.perf_counter()
+        response = clients[i % len(clients)].post('/send_message', json={'message': message})
+        latency = time.perf_counter() - t0
+        samples.append((response.get_json().get('intent', 'error'), latency))
+    elapsed = time.perf_counter() - started
+
+    result = {'rows': app.dataset.rows, 'startup_s': startup, 'rss_mb_after_load': rss_after_load}
+    result.update(summarize(samples, elapsed))
+    result['rss_mb_after_run'] = rss_mb()
+    print(json.dumps(result))
+
+def run_inprocess(args, rows, data_file):
+    command = [sys.executable, os.path.abspath(__file__), '_worker',
+               '--requests', str(args.requests), '--warmup', str(args.warmup), '--sessions', str(args.sessions),
+               '--mix', args.mix, '--seed', str(args.seed)]
+    if args.no_cache:
+        command.append('--no-cache')
+    completed = subprocess.run(command, env=worker_env(args, data_file), stdout=subprocess.PIPE, check=True)
+    return json.loads(completed.stdout.decode().strip().splitlines()[-1])
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def run_http(args, rows, data_file):
+    """Serve the app in a subprocess and drive it over HTTP from client threads"""
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    server_code = ("import app; from werkzeug.serving import run_simple; "
+                   f"run_simple('127.0.0.1', {port}, app.app, threaded=True)")
+    started = time.perf_counter()
+    server = subprocess.Popen([sys.executable, '-c', server_code], cwd=APP_DIR, env=worker_env(args, data_file),
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while True:
+            if server.poll() is not None:
+                raise RuntimeError(f"App server exited with code {server.returncode}")
+            try:
+                urllib.request.urlopen(base_url + '/', timeout=1).read()
+                break
+            except OSError:
+                time.sleep(0.05)
+        startup = time.perf_counter() - started
+        rss_after_load = rss_mb(server.pid)
+
+        help_text = json.loads(_post(urllib.request.build_opener(), base_url, 'help'))['bot_response']
+        clusters, products = _parse_help(help_text)
+        queries = build_queries(args.requests + args.warmup, parse_mix(args.mix), clusters, products, args.seed)
+        warmup, queries = queries[:args.warmup], queries[args.warmup:]
+
+        samples = []
+        lock = threading.Lock()
+
+        def client(worker_queries):
+            opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(CookieJar()))
+            local = []
+            for _, message in worker_queries:
+                t0 = time.perf_counter()
+                body = _post(opener, base_url, message)
+                local.append((json.loads(body).get('intent', 'error'), time.perf_counter() - t0))
+            with lock:
+                samples.extend(local)
+
+        client(warmup)
+        threads = [threading.Thread(target=client, args=(queries[i::args.concurrency],))
+                   for i in range(args.concurrency)]
+        run_started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - run_started
+
+        result = {'rows': rows, 'startup_s': startup, 'rss_mb_after_load': rss_after_load}
+        result.update(summarize(samples, elapsed))
+        result['rss_mb_after_run'] = rss_mb(server.pid)
+        return result
+    finally:
+        server.terminate()
+        server.wait()
+
+def _post(opener, base_url, message):
+    request = urllib.request.Request(base_url + '/send_message', data=json.dumps({'message': message}).encode(),
+                                     headers={'Content-Type': 'application/json'})
+    with opener.open(request, timeout=30) as response:
+        return response.read()
+
+def _parse_help(text):
+    """Pull the cluster ids and product categories out of the help answer"""
+    clusters, products = [0], ['electronics']
+    for line in text.splitlines():
+        if 'Available clusters:' in line:
+            clusters = [int(value) for value in line.split(':', 1)[1].split(',')]
+        elif 'Categories:' in line:
+            products = [value.strip() for value in line.split(':', 1)[1].split(',')]
+    return clusters, products
+
+def compare_to_baseline(results, baseline_path, tolerance):
+    """List metrics that got worse than the baseline by more than `tolerance` (a fraction)"""
+    with open(baseline_path) as f:
+        # Runs are only comparable within a mode: http latency includes the client and the network
+        baseline = {(run.get('mode', 'inprocess'), run['rows']): run for run in json.load(f)['runs']}
+    regressions = []
+    for run in results['runs']:
+        old = baseline.get((run['mode'], run['rows']))
+        if old is None:
+            continue
+        for metric in ('p50_ms', 'p95_ms', 'p99_ms'):
+            before, after = old['latency'].get(metric), run['latency'].get(metric)
+            if before and after and after > before * (1 + tolerance):
+                regressions.append(f"{run['rows']} rows: {metric} {before:.2f} -> {after:.2f}")
+        if old['throughput_rps'] and run['throughput_rps'] < old['throughput_rps'] * (1 - tolerance):
+            regressions.append(f"{run['rows']} rows: throughput {old['throughput_rps']:.1f} -> "
+                               f"{run['throughput_rps']:.1f} req/s")
+        if old['startup_s'] and run['startup_s'] > old['startup_s'] * (1 + tolerance):
+            regressions.append(f"{run['rows']} rows: startup {old['startup_s']:.2f}s -> {run['startup_s']:.2f}s")
+    return regressions
+
+def command_generate(args):
+    for rows, path in ensure_datasets(parse_sizes(args.sizes), args.data_dir, args.seed).items():
+        print(f"{rows}\t{path}")
+
+def command_run(args):
+    parse_mix(args.mix)
+    paths = ensure_datasets(parse_sizes(args.sizes), args.data_dir, args.seed)
+    runs = []
+    for rows, path in paths.items():
+        print(f"Benchmarking {rows} rows ({args.mode})...", file=sys.stderr)
+        result = run_http(args, rows, path) if args.mode == 'http' else run_inprocess(args, rows, path)
+        result['mode'] = args.mode
+        runs.append(result)
+        latency = result['latency']
+        print(f"  startup {result['startup_s']:.2f}s  rss {result['rss_mb_after_load'] or 0:.0f} MB  "
+              f"p50 {latency['p50_ms']:.2f}ms  p95 {latency['p95_ms']:.2f}ms  p99 {latency['p99_ms']:.2f}ms  "
+              f"{result['throughput_rps']:.0f} req/s", file=sys.stderr)
+
+    results = {
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': sys.version.split()[0],
+        'config': {key: value for key, value in vars(args).items() if key != 'func'},
+        'runs': runs,
+    }
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    if args.baseline:
+        regressions = compare_to_baseline(results, args.baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+def add_load_options(parser):
+    parser.add_argument('--requests', type=int, default=1000, help="measured requests per dataset size")
+    parser.add_argument('--warmup', type=int, default=50, help="unmeasured requests sent first")
+    parser.add_argument('--sessions', type=int, default=10, help="distinct chat sessions (in-process mode)")
+    parser.add_argument('--mix', default=DEFAULT_MIX, help="query mix as intent=weight,...")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-cache', action='store_true', help="disable the response cache in the app")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    generate = commands.add_parser('generate', help="write synthetic datasets")
+    generate.add_argument('--sizes', default=DEFAULT_SIZES, help="comma-separated row counts")
+    generate.add_argument('--data-dir', default=DEFAULT_DATA_DIR)
+    generate.add_argument('--seed', type=int, default=0)
+    generate.set_defaults(func=command_generate)
+
+    run = commands.add_parser('run', help="benchmark the chat endpoint")
+    run.add_argument('--sizes', default=DEFAULT_SIZES, help="comma-separated row counts")
+    run.add_argument('--data-dir', default=DEFAULT_DATA_DIR)
+    run.add_argument('--mode', choices=['inprocess', 'http'], default='inprocess')
+    run.add_argument('--concurrency', type=int, default=4, help="client threads (http mode)")
+    run.add_argument('--output', help="write JSON results here instead of stdout")
+    run.add_argument('--baseline', help="earlier results file to compare against")
+    run.add_argument('--tolerance', type=float, default=0.2, help="allowed slowdown before flagging, as a fraction")
+    add_load_options(run)
+    run.set_defaults(func=command_run)
+
+    worker = commands.add_parser('_worker')
+    add_load_options(worker)
+    worker.set_defaults(func=run_inprocess_worker)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,19 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault('CLUSTER_DATA_FILE', os.path.join(ROOT, 'ecommerce_customer_clusters_for_tableau.csv'))
+os.environ.setdefault('CLUSTER_RELOAD_INTERVAL', '0')
+os.environ.setdefault('CLUSTER_SHARED_DIR', '')
+sys.path.insert(0, ROOT)
+
+import app as chat_app  # noqa: E402
+
+
+@pytest.fixture
+def client():
+    chat_app.response_cache.clear()
+    return chat_app.app.test_client()
+
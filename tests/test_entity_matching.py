@@ -0,0 +1,88 @@
+import pytest
+
+import app as chat_app
+
+
+def send(client, message):
+    response = client.post('/send_message', json={'message': message})
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def entities(text, partial=()):
+    return [(mention.column, mention.value, mention.distance)
+            for mention in chat_app.dataset.entities.extract(text, partial)]
+
+
+def test_extract_phrases_in_order():
+    assert entities("mobile users paying by credit card in north america, cluster 3, aged 60+") == [
+        ('Device_Used', 'Mobile', 0),
+        ('Preferred_Payment_Method', 'Credit Card', 0),
+        ('Customer_Region', 'North America', 0),
+        ('Cluster', 3, 0),
+        ('Age_Group', '60+', 0),
+    ]
+
+
+def test_extract_corrects_typos():
+    assert entities("electornics buyers in nroth amercia") == [
+        ('Product_Category', 'Electronics', 1),
+        ('Customer_Region', 'North America', 2),
+    ]
+
+
+@pytest.mark.parametrize('word', ["sorts", "shorts", "table", "tables", "makes", "malls", "moles", "activate",
+                                  "actively", "worth", "some"])
+def test_everyday_words_are_not_corrected(word):
+    assert entities(f"what {word} of customers") == []
+
+
+def test_slice_filters_ignore_corrected_words():
+    assert chat_app.parse_slice_query("how many customers shop at malls", chat_app.dataset.entities) is None
+    assert chat_app.parse_slice_query("average income of tablte users", chat_app.dataset.entities) is None
+
+
+def test_partial_words_only_for_requested_columns():
+    assert entities("sportswear") == []
+    assert entities("sportswear", partial=('Product_Category',)) == [('Product_Category', 'Sports', 0)]
+
+
+@pytest.mark.parametrize('message, product', [
+    ("fashionable clothes", "Fashion"),
+    ("sportswear", "Sports"),
+    ("homeware", "Home"),
+    ("which cluster buys electronics", "Electronics"),
+    ("which cluster buys electornics", "Electronics"),
+    # Mentions as written win over corrected ones, then the data's order of appearance
+    ("electronics or fashon", "Electronics"),
+])
+def test_product_cluster_matching(client, message, product):
+    reply = send(client, message)
+    assert reply['intent'] == 'product_cluster'
+    assert reply['bot_response'].startswith(f"**{product} Analysis:**")
+
+
+def test_product_cluster_states_corrections(client):
+    reply = send(client, "which cluster buys electornics")
+    assert "*(reading 'electornics' as Electronics)*" in reply['bot_response'].splitlines()[0]
+    assert "reading" not in send(client, "which cluster buys electronics")['bot_response']
+
+
+def test_follow_up_routing_after_cluster_lookup(client):
+    send(client, "tell me about cluster 2")
+    reply = send(client, "what sorts of income do they have")
+    assert reply['intent'] == 'follow_up'
+    assert reply['bot_response'].startswith("💰 **Cluster 2 Income Details:**")
+    reply = send(client, "how old are they on average")
+    assert reply['intent'] == 'follow_up'
+    assert reply['bot_response'].startswith("👨‍👩‍👧‍👦 **Cluster 2 Age Details:**")
+
+
+def test_follow_up_ignores_typo_guesses_but_not_products(client):
+    send(client, "tell me about cluster 1")
+    reply = send(client, "what income do sprots fans have")
+    assert reply['intent'] == 'follow_up'
+    assert "Cluster 1" in reply['bot_response']
+    reply = send(client, "what income do sports fans have")
+    assert reply['intent'] == 'product_cluster'
+    assert reply['bot_response'].startswith("**Sports Analysis:**")
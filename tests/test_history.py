@@ -0,0 +1,35 @@
+import re
+
+
+def history_ids(response):
+    return [entry['id'] for entry in response.get_json()]
+
+
+def next_link(response):
+    found = re.match(r'<([^>]+)>; rel="next"', response.headers.get('Link', ''))
+    return found.group(1) if found else None
+
+
+def test_history_pages_stay_inside_the_after_cursor(client):
+    client.post('/clear_history')
+    for message in ["hello", "help", "tell me about cluster 1", "income", "age", "orders", "reviews"]:
+        assert client.post('/send_message', json={'message': message}).status_code == 200
+    ids = history_ids(client.get('/get_chat_history'))
+    after = ids[2]
+
+    pages = []
+    url = f'/get_chat_history?after={after}&limit=2'
+    while url:
+        response = client.get(url)
+        pages.append(history_ids(response))
+        url = next_link(response)
+
+    assert [entry for page in reversed(pages) for entry in page] == [i for i in ids if i > after]
+    assert all(len(page) <= 2 for page in pages)
+
+
+def test_history_without_older_entries_has_no_link(client):
+    client.post('/clear_history')
+    client.post('/send_message', json={'message': "hello"})
+    response = client.get('/get_chat_history?limit=5')
+    assert 'Link' not in response.headers
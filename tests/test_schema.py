@@ -0,0 +1,23 @@
+import pandas as pd
+import pytest
+
+import app as chat_app
+
+
+@pytest.mark.parametrize('column, value', [('Age', 35.7), ('Review_Score', 4.5)])
+def test_fractional_values_in_integer_columns_are_rejected(tmp_path, column, value):
+    df = pd.read_csv(chat_app.DATA_FILE, nrows=50)
+    df[column] = df[column].astype('float64')
+    df.loc[3, column] = value
+    path = tmp_path / 'clusters.csv'
+    df.to_csv(path, index=False)
+    with pytest.raises(ValueError, match='non-integer'):
+        chat_app.read_clusters_csv(path)
+
+
+def test_whole_floats_in_integer_columns_load(tmp_path):
+    df = pd.read_csv(chat_app.DATA_FILE, nrows=50)
+    df['Age'] = df['Age'].astype('float64')
+    path = tmp_path / 'clusters.csv'
+    df.to_csv(path, index=False)
+    assert chat_app.read_clusters_csv(path)['Age'].dtype == chat_app.CSV_SCHEMA['Age']
@@ -0,0 +1,98 @@
+import pytest
+
+import app as chat_app
+
+
+@pytest.fixture(params=['frame', 'aggregate'])
+def snap(request):
+    if request.param == 'frame':
+        return chat_app.dataset
+    frame = chat_app.dataset
+    return chat_app.AggregateSnapshot(frame.cube, frame.rows, frame.fingerprint, frame.digest)
+
+
+def parse(text):
+    return chat_app.parse_slice_query(text, chat_app.dataset.entities)
+
+
+def test_parse_statistic_measure_and_filters():
+    query = parse("average order value of mobile users in asia in cluster 2")
+    assert query.statistic == 'mean'
+    assert query.measure == 'Average_Order_Value'
+    assert query.filters == {'Device_Used': ['Mobile'], 'Customer_Region': ['Asia'], 'Cluster': [2]}
+    assert query.by is None
+
+
+def test_parse_breakdown_is_not_read_as_a_measure():
+    query = parse("how many customers by age group")
+    assert query.statistic == 'count'
+    assert query.measure is None
+    assert query.by == 'Age_Group'
+
+
+def test_parse_filter_and_breakdown_on_the_same_dimension():
+    query = parse("average income by region in europe and asia")
+    assert query.by == 'Customer_Region'
+    assert query.filters == {'Customer_Region': ['Europe', 'Asia']}
+
+
+def test_parse_cluster_lists():
+    assert parse("how many customers in clusters 0 and 3").filters == {'Cluster': [0, 3]}
+
+
+def test_parse_count_of_orders_is_their_total():
+    query = parse("how many orders did cluster 2 place")
+    assert query.statistic == 'sum'
+    assert query.measure == 'Number_of_Orders'
+    assert query.filters == {'Cluster': [2]}
+
+
+def test_parse_count_of_a_measure_that_isnt_a_count():
+    assert parse("how many reviews in europe") is None
+
+
+def test_parse_rejects_plain_chat():
+    assert parse("tell me about cluster 2") is None
+
+
+def test_count_matches_frame(snap):
+    df = chat_app.dataset.df
+    expected = int(((df['Customer_Region'] == 'Europe') & (df['Device_Used'] == 'Tablet')).sum())
+    response = chat_app.slice_query_response("how many tablet users in europe", snap)
+    assert f"**{expected}** customers" in response
+
+
+@pytest.mark.parametrize('question, by, values', [
+    ("how many customers by region in europe", 'Customer_Region', ['Europe']),
+    ("how many customers by cluster in cluster 3", 'Cluster', [3]),
+    ("average income by region in europe and asia", 'Customer_Region', ['Europe', 'Asia']),
+])
+def test_breakdown_over_a_filtered_dimension(snap, question, by, values):
+    df = chat_app.dataset.df
+    response = chat_app.slice_query_response(question, snap)
+    lines = [line for line in response.splitlines() if line.startswith('• ')]
+    assert len(lines) == len(values)
+    for line, value in zip(lines, values):
+        label = chat_app.slice_value_label(by, value)
+        count = int((df[by] == value).sum())
+        assert line.startswith(f"• **{label}:**")
+        assert f"{count} customers" in line
+
+
+def test_breakdown_over_a_filtered_dimension_via_route(client):
+    response = client.post('/send_message', json={'message': "how many customers by region in europe"})
+    assert response.status_code == 200
+    assert "**Europe:**" in response.get_json()['bot_response']
+    assert "**Asia:**" not in response.get_json()['bot_response']
+
+
+@pytest.mark.parametrize('question, column, value', [
+    ("how many orders did cluster 2 place", 'Cluster', 2),
+    ("how many orders in europe", 'Customer_Region', 'Europe'),
+])
+def test_count_of_orders_answers_their_total(snap, question, column, value):
+    df = chat_app.dataset.df
+    total = int(df.loc[df[column] == value, 'Number_of_Orders'].sum())
+    response = chat_app.slice_query_response(question, snap)
+    assert response.startswith("📊 **Total Orders**")
+    assert f"**{total:,}**" in response
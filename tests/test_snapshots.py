@@ -0,0 +1,25 @@
+import app as chat_app
+
+
+def test_unusable_snapshot_directory_falls_back_to_the_csv(tmp_path):
+    blocker = tmp_path / 'not-a-directory'
+    blocker.write_text('')
+    snap = chat_app.build_shared_snapshot(chat_app.DATA_FILE, str(blocker / 'snaps'))
+    assert snap.source == 'csv'
+    assert snap.rows == chat_app.dataset.rows
+
+
+def test_failed_export_falls_back_to_the_parsed_csv(tmp_path, monkeypatch):
+    def read_only(snap, directory):
+        raise PermissionError(13, 'Permission denied', directory)
+
+    monkeypatch.setattr(chat_app, 'export_shared', read_only)
+    snap = chat_app.build_shared_snapshot(chat_app.DATA_FILE, str(tmp_path / 'snaps'))
+    assert snap.source == 'csv'
+    assert snap.rows == chat_app.dataset.rows
+
+
+def test_snapshot_is_reused(tmp_path):
+    root = str(tmp_path / 'snaps')
+    assert chat_app.build_shared_snapshot(chat_app.DATA_FILE, root).source == 'snapshot rebuilt'
+    assert chat_app.build_shared_snapshot(chat_app.DATA_FILE, root).source == 'snapshot hit'